@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+""" client.py
+Thin client for a resident naga server (naga.py --server). It takes the same
+arguments as naga.py and prints and exits the same way, but leaves the work
+to the server, so nagios does not pay for starting naga for every check.
+When no server is listening naga.py is run instead.
+"""
+
+import os
+import socket
+import sys
+
+SOCKET = os.environ.get('NAGA_SOCKET', '/tmp/naga-server.sock')
+
+def run_naga(args):
+    """ Replace this process with naga.py run with args."""
+    naga = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'naga.py')
+    os.execv(sys.executable, [sys.executable, naga] + args)
+
+def main():
+    """ Send the command line to the server and relay its answer."""
+    args = sys.argv[1:]
+    if not args:
+        # the server does not answer empty requests
+        run_naga(args)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET)
+    except socket.error:
+        run_naga(args)
+    sock.sendall(''.join([arg + '\0' for arg in args]))
+    sock.shutdown(socket.SHUT_WR)
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    code, _, output = ''.join(chunks).partition('\n')
+    out, _, err = output.partition('\0')
+    try:
+        code = int(code)
+    except ValueError:
+        out, code = 'Unknown: no answer from naga server %s\n' % SOCKET, 3
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
@@ -6,29 +6,135 @@ line.
 
 import optparse
 import subprocess
+import sys
 import time
 import logging
+import os
+import stat
+import socket
+import fcntl
+import random
+import select
+import signal
+import tempfile
+import hashlib
+import fnmatch
+import glob
+import re
+import math
+import threading
+import errno
 
 DIVIDE = 'NAGA_DIVIDE'
+BATCH_DIVIDE = 'NAGA_BATCH'
+SAMPLE_DIVIDE = 'NAGA_SAMPLE'
 INFO_DEFAULT = 'load'
 INFO_CHOICES = {
  'load': ['/bin/cat', '/proc/loadavg', '&&', '/bin/cat', '/proc/cpuinfo', '|',
      '/bin/grep', "'model name'", '|', 'wc', '-l'],
- 'memory': ['/usr/bin/free', '-m'],
- 'cpu': ['/bin/cat', '/proc/stat', '&&', '/bin/sleep', '1', '&&', '/bin/cat',
-     '/proc/stat'],
- 'disk':['/usr/bin/vmstat', '10', '2'],
- 'network': [
-    '/bin/ls', '/sys/class/net/', '&&', '/bin/echo', DIVIDE, '&&',
-    '/bin/cat', '/sys/class/net/*/statistics/rx_bytes', '&&', 
-    '/bin/cat', '/sys/class/net/*/statistics/tx_bytes', '&&',
-    '/bin/sleep', '10', '&&',
-    '/bin/cat', '/sys/class/net/*/statistics/rx_bytes', '&&', 
-    '/bin/cat', '/sys/class/net/*/statistics/tx_bytes',
-    ],
+ 'memory': ['/bin/cat', '/proc/meminfo', '||', '/usr/bin/free', '-m'],
+ 'cpu': ['/bin/grep', "'^cpu'", '/proc/stat', '&&', '/bin/sleep', '1', '&&',
+     '/bin/grep', "'^cpu'", '/proc/stat'],
+ 'disk': ['/bin/cat', '/proc/uptime', '/proc/diskstats', '&&', '/bin/echo',
+     DIVIDE, '&&', '/bin/sleep', '1', '&&', '/bin/cat', '/proc/uptime',
+     '/proc/diskstats', '||', '/usr/bin/vmstat', '1', '2'],
+ 'network': ['/bin/cat', '/proc/uptime', '/proc/net/dev', '&&', '/bin/echo',
+     DIVIDE, '&&', '/bin/sleep', '10', '&&', '/bin/cat', '/proc/uptime',
+     '/proc/net/dev'],
  'filesystem': ['/bin/df', '-P']
  }
 
+# Files and commands the INFO_CHOICES commands need, and the commands used
+# on hosts without them (in order of preference) when hosts are probed, see
+# probe().
+INFO_NEEDS = {
+ 'load': ['/proc/loadavg', '/proc/cpuinfo'],
+ 'memory': ['/proc/meminfo'],
+ 'cpu': ['/proc/stat'],
+ 'disk': ['/proc/diskstats'],
+ 'network': ['/proc/net/dev'],
+ 'filesystem': ['/bin/df'],
+ }
+INFO_VARIANTS = {
+ 'memory': [(['/usr/bin/free'], ['/usr/bin/free', '-m'])],
+ 'disk': [(['/usr/bin/vmstat'], ['/usr/bin/vmstat', '1', '2'])],
+ 'filesystem': [(['/usr/bin/bdf'], ['/usr/bin/bdf'])],
+ }
+PROBE_TTL = 86400
+
+# Single reads of the counters behind the info types that compute rates,
+# see counters().
+COUNTER_CHOICES = {
+ 'cpu': ['/bin/grep', "'^cpu'", '/proc/stat'],
+ 'disk': ['/bin/cat', '/proc/diskstats'],
+ 'network': ['/bin/cat', '/proc/net/dev'],
+ }
+# Only lines starting with these are kept from the counters of an info type.
+COUNTER_KEEP = {'cpu': 'cpu'}
+# Seconds to sleep between two reads when there is no usable previous sample.
+COUNTER_SLEEP = {'cpu': 1, 'disk': 1, 'network': 10}
+COUNTER_MIN_AGE = 1
+COUNTER_MAX_AGE = 900
+MEMORY_BASIS = 'available'
+# What the memory level can be based on (see memory()) and how it is
+# described.
+MEMORY_BASES = {'available': '', 'used': 'excluding buffers/cache',
+        'swap': 'of swap', 'committed': 'of the commit limit'}
+TOP_CORES = 5 # hottest cores listed by cpu -s hottest/imbalance
+NETWORK_WINDOW = 10 # seconds between the two reads of the network counters
+DISK_WINDOW = 1 # seconds between the two reads of the disk counters
+SECTOR = 512 # bytes, /proc/diskstats always counts in 512 byte sectors
+
+STATE_DIR = '/var/tmp/naga'
+CACHE_SIZE = 1000 # results kept in the result cache
+CONTROL_DIR = '/tmp/naga'
+CONTROL_PERSIST = 300 # seconds an idle master is kept open
+MAX_MASTERS = 64
+# Masters started without waiting for them (by the scheduler), by control
+# path: (ssh process, lock file, time to give up on it).
+STARTING_MASTERS = {}
+
+# ssh exits with this when it could not connect
+SSH_FAILURE = 255
+BREAKER_BACKOFF = 30 # seconds before probing a host again, doubled per failure
+BREAKER_MAX_BACKOFF = 900
+LATENCY_SAMPLES = 64 # latencies kept per host for the adaptive deadline
+LATENCY_MIN_SAMPLES = 5 # latencies needed before the deadline adapts
+DEADLINE_PERCENTILE = 99
+DEADLINE_FLOOR = 2 # seconds, the least an adaptive deadline allows
+
+TRANSPORT_CHOICES = ['auto', 'local', 'ssh', 'mux', 'replay']
+# Hosts the auto transport checks without ssh.
+LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+# Commands the local transport runs in process, and the options they take.
+LOCAL_COMMANDS = {'cat': [], 'echo': [], 'sleep': [], 'exit': []}
+LOCAL_SEPARATORS = ['&&', '||', ';']
+REPLAY_DIR = 'test/static'
+# Remote command of --script, it reads the script rendered by
+# remote_script() from its input.
+SCRIPT_COMMAND = ['/bin/sh', '-s']
+SCRIPT_READ = 'while IFS= read -r l || [ -n "$l" ]; do'
+
+INTERVAL = 300 # seconds between runs of a scheduled check
+JITTER = 0.1 # fraction of the interval each run is randomly moved by
+MAX_CONCURRENT = 64
+MAX_PER_HOST = 2
+FLUSH_INTERVAL = 5 # seconds between bulk submissions of results
+
+AGGREGATE_DEFAULT = 'max'
+EXPORT_CHUNK = 4096 # bytes written at once, no more than PIPE_BUF
+EXPORT_MAX_LINES = 100000 # lines buffered for the export, the oldest are dropped
+
+# Order of severity used when combining several results into one status.
+STATUS_ORDER = [0, 1, 3, 2]
+
+# Prefixes of the interfaces network checks by default, in order.
+NET_DEFAULT = ['eth', 'en', 'wlan', 'wl', 'wwan', 'ww']
+# Characters -s may use where it becomes part of the remote command line,
+# anything else could be interpreted by a shell.
+SAFE_MOUNT = re.compile(r'^[A-Za-z0-9_./@%+:=][A-Za-z0-9_./@%+:=-]*$')
+SAFE_INTERFACE = re.compile(r'^[A-Za-z0-9_.@%+:=*?!\[\]^-]+$')
+
 INFO_LEVELS = {
  'load'     : [1.0, 2.0],
  'memory'   : [0.9, 0.95],
@@ -47,14 +153,22 @@ INFO_UNITS  = {
  'filesystem': '%',
 }
 
-def timecheck(start_time, timeout, after, proc=None,):
+def timecheck(start_time, timeout, after):
     """ Check if timeout has expired, exit with unknown status if it has."""
     if time.time()-start_time > timeout:
-        if proc is not None:
-            proc.terminate()
         raise NagaExit(3, 'timeout after %s (%ss)' % (after, timeout))
 
-def parse_opts():
+def reap(proc):
+    """ Kill proc unless it has exited, wait for it and close its pipes, so
+    that neither a zombie nor open fds are left behind."""
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        if pipe is not None:
+            pipe.close()
+
+def parse_opts(args=None):
     """ Parse the command line options given to naga."""
     desc = 'A python plugin for the Nagios monitoring system that connects \
 to remote hosts via ssh.'
@@ -62,11 +176,15 @@ to remote hosts via ssh.'
 arguments:
  INFO        SPECIAL ARGUMENTS
  load        n/a
- memory      n/a
- cpu         cpu0, cpu1... (default is total)
- disk        n/a
- network     wlan0, eth0... (default is total)
+ memory      available (default), used, swap, committed
+ cpu         cpu0, cpu1... (default is total), hottest, imbalance
+ disk        sda, nvme0n1... (default is all disks)
+ network     wlan0, eth0..., !veth* (default is the first ethernet)
  filesystem  /, /dev/sda1... (default is /)
+
+disk, network and filesystem accept a comma separated list of names and glob
+patterns (e.g. '/,/data*'), the status is that of the worst match. Network
+interfaces matching a !pattern are left out (e.g. '!veth*,!lo').
 """
     optparse.OptionParser.format_epilog = lambda self, formatter: self.epilog
     parser = optparse.OptionParser(description=desc, epilog=epilog)
@@ -79,7 +197,12 @@ arguments:
     parser.add_option('-c', '--critical',
         help='Critical threshold (percentage)')
     parser.add_option('-H', '--hostname', default='localhost',
-        help='The hostname or ip of target system.')
+        help='The hostname or ip of target system, or a comma separated '
+        'list of them (or @file, one per line) to check as a cluster.')
+    parser.add_option('--aggregate', default=AGGREGATE_DEFAULT,
+        help='How a cluster check reduces the levels of its hosts: max '
+        '(default), min, mean, pN (Nth percentile) or count[:level] (number '
+        'of hosts at or over level, default the warning level of info).')
     parser.add_option('-v', '--verbose', action='store_true',
         help='Enable verbose output.')
 
@@ -98,15 +221,760 @@ arguments:
         help='Which type of information to return.')
     parser.add_option('-s', '--special',
         help='Any special arguments (specific to each information type)')
+    parser.add_option('--top-cores', default=str(TOP_CORES),
+        help='Number of the hottest cores listed by cpu -s hottest or '
+        'imbalance (default %s).' % TOP_CORES)
+    parser.add_option('--network-window', default=str(NETWORK_WINDOW),
+        help='Seconds between the two reads of the network counters.')
+    parser.add_option('--disk-window', default=str(DISK_WINDOW),
+        help='Seconds between the two reads of the disk counters.')
+    parser.add_option('--block', default='1024',
+        help='Block size (bytes) of the bi/bo columns when disk falls back '
+        'to vmstat (default 1024).')
+    parser.add_option('--breaker-failures', default='0',
+        help='Connection failures or timeouts in a row after which checks '
+        'of a host fail fast without connecting (default 0, never).')
+    parser.add_option('--breaker-backoff', default=str(BREAKER_BACKOFF),
+        help='Seconds before a host that failed is probed again, doubled '
+        'after each failed probe (up to %ss).' % BREAKER_MAX_BACKOFF)
+    parser.add_option('--deadline-factor', default='0',
+        help='Cut a check off once it takes this many times the p%s of the '
+        'latencies recorded for the host (plus the sampling sleeps), '
+        'instead of waiting for the timeout (default 0, always wait).'
+        % DEADLINE_PERCENTILE)
+    parser.add_option('--deadline-floor', default=str(DEADLINE_FLOOR),
+        help='Seconds an adaptive deadline allows at least (default %s).'
+        % DEADLINE_FLOOR)
+    parser.add_option('-m', '--multiplex', action='store_true',
+        help='Reuse a persistent ssh master connection for each host.')
+    parser.add_option('--transport', default='auto',
+            choices=TRANSPORT_CHOICES,
+        help='How to reach the host: local (no ssh), ssh, mux (ssh over a '
+        'master connection), replay (captured outputs, see --replay-dir) or '
+        'auto (default): local for %s, mux with -m, else ssh.' % ', '.join(
+            LOCAL_HOSTS))
+    parser.add_option('--replay-dir', default=REPLAY_DIR,
+        help='Directory of the <info>_<name>.txt captures the replay '
+        'transport answers with (default %s).' % REPLAY_DIR)
+    parser.add_option('--replay-latency', default='0',
+        help='Seconds the replay transport takes to answer.')
+    parser.add_option('--replay-jitter', default='0',
+        help='Seconds the replay latency randomly varies by.')
+    parser.add_option('--replay-failures', default='0',
+        help='Fraction of replayed checks that fail to connect.')
+    parser.add_option('--control-dir', default=CONTROL_DIR,
+        help='Directory for ssh control sockets (default %s).' % CONTROL_DIR)
+    parser.add_option('--control-persist', default=str(CONTROL_PERSIST),
+        help='Seconds an idle master connection stays open.')
+    parser.add_option('--max-masters', default=str(MAX_MASTERS),
+        help='Maximum number of open master connections.')
+    parser.add_option('--batch',
+        help='Comma separated info types (optionally info:special, or all) '
+        'to check over a single ssh session.')
+    parser.add_option('--command-file',
+        help='Nagios external command file, batch results are also '
+        'submitted to it as passive service checks.')
+    parser.add_option('--checkresults-dir',
+        help='Nagios check result spool directory, scheduler results are '
+        'written to it.')
+    parser.add_option('--scheduler',
+        help='Run as a scheduler for the checks listed in this inventory '
+        'file, see README.')
+    parser.add_option('--once', action='store_true',
+        help='With --scheduler, run every check once and exit.')
+    parser.add_option('--interval', default=str(INTERVAL),
+        help='Default seconds between runs of a scheduled check.')
+    parser.add_option('--jitter', default=str(JITTER),
+        help='Fraction of the interval to randomly vary each run by.')
+    parser.add_option('--max-concurrent', default=str(MAX_CONCURRENT),
+        help='Maximum number of checks the scheduler runs at once.')
+    parser.add_option('--max-per-host', default=str(MAX_PER_HOST),
+        help='Maximum number of checks the scheduler runs at once per host.')
+    parser.add_option('--flush-interval', default=str(FLUSH_INTERVAL),
+        help='Seconds between bulk submissions of scheduler results.')
+    parser.add_option('--counters', action='store_true',
+        help='Compute cpu, disk and network rates against the counters '
+        'stored by the previous check instead of sleeping between reads.')
+    parser.add_option('--counter-max-age', default=str(COUNTER_MAX_AGE),
+        help='Seconds after which stored counters are too old to use.')
+    parser.add_option('--cache-ttl', default='0',
+        help='Seconds to reuse the output fetched from a host by another '
+        'naga process (default 0, no caching).')
+    parser.add_option('--cache-size', default=str(CACHE_SIZE),
+        help='Maximum number of outputs kept in the result cache.')
+    parser.add_option('--probe-ttl', default='0',
+        help='Probe each host for the files and commands the checks need '
+        'and reuse what was found for this many seconds, so checks use a '
+        'command that works on the host (default 0, no probing; %s is a '
+        'day).' % PROBE_TTL)
+    parser.add_option('--state-dir', default=STATE_DIR,
+        help='Directory naga keeps its state in (default %s).' % STATE_DIR)
+    parser.add_option('--export',
+        help='Also write every parsed value at full precision in line '
+        'protocol to this file, named pipe or unix socket, without ever '
+        'waiting for it.')
+    parser.add_option('--profile', action='store_true',
+        help='Add the time spent in each phase of the check as perfdata.')
+    parser.add_option('--server',
+        help='Run as a resident server answering checks from naga/client.py '
+        'on this unix socket.')
+    parser.add_option('--script', action='store_true',
+        help='Send the remote commands as one shell script doing most of '
+        'the work with shell builtins, so fewer processes are started on '
+        'the remote host.')
+    parser.add_option('-C', '--compress', action='store_true',
+        help='Compress the ssh session, for checks with large outputs.')
     parser.add_option('--capture',
         help='Capture output of ssh, used for testing and debugging only.')
 
-    return parser.parse_args()
+    return parser.parse_args(args)
 
-def connect(hostname, info, timeout, binary, start_time=None, **kwargs):
+def build_command(info, **kwargs):
+    """ Remote command for info. When targets are given with -s only what
+    they need is read and sent back."""
+    special = kwargs.get('special')
+    if info == 'network' and (special or 'network_window' in kwargs):
+        window = str(kwargs.get('network_window', NETWORK_WINDOW))
+        read = ['/bin/cat', '/proc/uptime', '&&'] + network_read(special)
+        return read + ['&&', '/bin/echo', DIVIDE, '&&', '/bin/sleep', window,
+                '&&'] + read
+    if info == 'disk' and 'disk_window' in kwargs:
+        window = str(kwargs['disk_window'])
+        read = ['/bin/cat', '/proc/uptime', '/proc/diskstats']
+        return read + ['&&', '/bin/echo', DIVIDE, '&&', '/bin/sleep', window,
+                '&&'] + read + ['||', '/usr/bin/vmstat', window, '2']
+    if info == 'filesystem' and special and not is_pattern(special):
+        # df -P /data* would also match directories that are not mounts.
+        # df fails for a missing mount, filesystem() reports it instead.
+        return INFO_CHOICES[info] + safe_names(special, SAFE_MOUNT,
+                'mount') + ['||', 'true']
+    return INFO_CHOICES[info]
+
+def network_read(special):
+    """ Command reading the /proc/net/dev lines of the interfaces special
+    includes (all of them when it names none, see split_patterns()).
+    Patterns are matched with grep -E on the remote host, which succeeds
+    when none match so that network() reports the missing interfaces."""
+    include = split_patterns(special or '')[0]
+    if not include:
+        return ['/bin/cat', '/proc/net/dev']
+    alternatives = []
+    for pattern in safe_names(include, SAFE_INTERFACE, 'interface'):
+        regex = pattern.replace('.', '[.]').replace('[!', '[^')
+        alternatives.append(regex.replace('*', '[^:]*').replace('?', '[^:]'))
+    return ['/bin/grep', '-E', "'^ *(%s):'" % '|'.join(alternatives),
+            '/proc/net/dev', '||', 'true']
+
+def safe_names(special, safe, kind):
+    """ The comma separated names in special, checked against the safe
+    regex before they are put into a command line."""
+    names = [name.strip() for name in special.split(',')]
+    for name in names:
+        if not safe.match(name):
+            raise NagaExit(3, 'invalid %s %s' % (kind, name))
+    return names
+
+def connect(hostname, info, timeout, binary, start_time=None, command=None,
+        **kwargs):
     """ Connect to remote machine via ssh and run relevant command."""
     if start_time == None:
         start_time = time.time()
+    began = time.time()
+    if command is None:
+        command = build_command(info, **kwargs)
+    timeout = deadline(hostname, command, timeout, start_time, **kwargs)
+    profile = kwargs.get('profile')
+    name = transport(hostname, **kwargs)
+    payload = command
+    if name == 'replay':
+        payload = replay_command(hostname, info, **kwargs)
+    if name in ('local', 'replay'):
+        steps = parse_local(payload)
+        if steps is None:
+            raise NagaExit(3, 'cannot run %s without a shell' %
+                    ' '.join(payload))
+        logging.debug('running %s in process', ' '.join(payload))
+        try:
+            out = run_local(steps, start_time, timeout)
+        finally:
+            record_latency(hostname, command, began, **kwargs)
+        if profile is not None:
+            profile.mark('local')
+        return out
+    breaker(hostname, **kwargs)
+    payload, script = remote_payload(payload, **kwargs)
+    cmd = transport_command(hostname, timeout, binary, start_time, payload,
+            **kwargs)
+    logging.debug('about to Popen %s', cmd)
+    proc = spawn(cmd, script)
+    if profile is not None:
+        profile.mark('ssh')
+    try:
+        out = communicate(proc, start_time, timeout, kwargs.get('done'),
+                profile)
+    except NagaExit:
+        record_health(hostname, False, **kwargs)
+        record_latency(hostname, command, began, **kwargs)
+        raise
+    record_health(hostname, out[0] != SSH_FAILURE, **kwargs)
+    if out[0] != SSH_FAILURE:
+        record_latency(hostname, command, began, **kwargs)
+    return out
+
+def spawn(cmd, script=None):
+    """ Start the shell command line cmd, sending script to its input."""
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, stdin=script is not None and
+            subprocess.PIPE or None)
+    if script is not None:
+        try:
+            proc.stdin.write(script)
+        except IOError:
+            # ssh exited early, its return code tells why
+            pass
+        finally:
+            proc.stdin.close()
+    return proc
+
+def breaker(hostname, **kwargs):
+    """ Fail fast while the circuit of hostname is open: after
+    breaker_failures connection failures in a row, checks exit unknown
+    without connecting. One check per backoff period gets through to probe
+    the host, the period doubles with every failed probe."""
+    path = health_file(hostname, **kwargs)
+    if path is None:
+        return
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        failures, retry_at = read_health(path)
+        threshold = int(kwargs['breaker_failures'])
+        if failures < threshold:
+            return
+        now = time.time()
+        if now < retry_at:
+            raise NagaExit(3, '%s is unreachable (%s failures), next probe in '
+                    '%ss' % (hostname, failures, int(retry_at - now) + 1))
+        # concurrent checks keep failing fast until this probe is recorded
+        write_state(path, '%s %s' % (failures, now + backoff(failures -
+            threshold, **kwargs)))
+
+def record_health(hostname, reachable, **kwargs):
+    """ Record whether a check could reach hostname for breaker()."""
+    path = health_file(hostname, **kwargs)
+    if path is None:
+        return
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        failures = read_health(path)[0]
+        if reachable:
+            if failures:
+                logging.info('%s is reachable again', hostname)
+                write_state(path, '0 0')
+            return
+        failures += 1
+        threshold = int(kwargs['breaker_failures'])
+        retry_at = 0
+        if failures >= threshold:
+            retry_at = time.time() + backoff(failures - threshold, **kwargs)
+        write_state(path, '%s %s' % (failures, retry_at))
+
+def health_file(hostname, **kwargs):
+    """ Path of the health state of hostname, None if the circuit
+    breaker is not used for it."""
+    if int(kwargs.get('breaker_failures') or 0) <= 0:
+        return None
+    if transport(hostname, **kwargs) == 'local':
+        return None
+    return state_file(kwargs.get('state_dir', STATE_DIR), 'health', hostname)
+
+def read_health(path):
+    """ Return the failures in a row and the time of the next probe."""
+    data = read_state(path)
+    if not data:
+        return 0, 0
+    failures, retry_at = data.split()
+    return int(failures), float(retry_at)
+
+def backoff(probes, **kwargs):
+    """ Seconds to wait before the next probe after probes failed."""
+    base = float(kwargs.get('breaker_backoff', BREAKER_BACKOFF))
+    return min(base * 2 ** min(probes, 32), BREAKER_MAX_BACKOFF)
+
+def deadline(hostname, command, timeout, start_time, **kwargs):
+    """ Seconds after start_time by which command has to be done on
+    hostname: the p99 of the latencies recorded for the host times
+    deadline_factor (at least deadline_floor), plus the sleeps of command
+    and the time already spent. Capped by timeout, which is used as is
+    until enough latencies have been recorded."""
+    path = latency_file(hostname, **kwargs)
+    if path is None:
+        return timeout
+    history = read_latencies(path)
+    if len(history) < LATENCY_MIN_SAMPLES:
+        return timeout
+    allowance = max(percentile(sorted(history), DEADLINE_PERCENTILE) *
+            float(kwargs['deadline_factor']), float(kwargs.get(
+                'deadline_floor', DEADLINE_FLOOR)))
+    limit = time.time() - start_time + sleeps(command) + allowance
+    if limit >= float(timeout):
+        return timeout
+    logging.debug('adaptive deadline for %s is %.1fs', hostname, limit)
+    return round(limit, 3)
+
+def record_latency(hostname, command, began, **kwargs):
+    """ Record how long command took on hostname since began, less its
+    sleeps, for deadline(). Commands cut off by their deadline are recorded
+    too, so the deadline of a host that became slower grows with every
+    check until it fits again (or reaches the timeout)."""
+    path = latency_file(hostname, **kwargs)
+    if path is None:
+        return
+    latency = max(time.time() - began - sleeps(command), 0)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        history = read_latencies(path) + [latency]
+        write_state(path, ' '.join(['%.3f' % seconds for seconds in
+            history[-LATENCY_SAMPLES:]]))
+
+def latency_file(hostname, **kwargs):
+    """ Path of the latency history of hostname, None if deadlines are not
+    adapted for it."""
+    if float(kwargs.get('deadline_factor') or 0) <= 0:
+        return None
+    if transport(hostname, **kwargs) == 'local':
+        return None
+    return state_file(kwargs.get('state_dir', STATE_DIR), 'latency', hostname)
+
+def read_latencies(path):
+    """ The latencies recorded at path, oldest first."""
+    return [float(seconds) for seconds in (read_state(path) or '').split()]
+
+def sleeps(command):
+    """ Seconds the sleep commands in command sleep for."""
+    return sum([float(arg) for name, arg in zip(command, command[1:])
+        if os.path.basename(name) == 'sleep'])
+
+def fetch(hostname, info, timeout, binary, start_time, command=None,
+        **kwargs):
+    """ connect() through the result cache. Outputs are kept for cache_ttl
+    seconds per host, info, special argument and command. Processes that
+    want the same output at the same time wait for the first of them to
+    fetch it instead of each opening their own ssh session."""
+    ttl = float(kwargs.get('cache_ttl') or 0)
+    if ttl <= 0:
+        return connect(hostname, info, timeout, binary, start_time, command,
+                **kwargs)
+    if command is None:
+        command = build_command(info, **kwargs)
+    path = state_file(kwargs.get('state_dir', STATE_DIR), 'cache', hostname,
+            info, kwargs.get('special', ''), command_digest(command))
+    out = cached_result(path, ttl)
+    if out is not None:
+        return out
+    with open(path + '.lock', 'w') as lock:
+        wait_lock(lock, start_time, timeout, 'cache')
+        out = cached_result(path, ttl)
+        if out is not None:
+            return out
+        out = connect(hostname, info, timeout, binary, start_time, command,
+                **kwargs)
+        if out[0] == 0:
+            write_state(path, out[1])
+            evict(os.path.dirname(path),
+                    int(kwargs.get('cache_size', CACHE_SIZE)))
+    return out
+
+def command_digest(command):
+    """ Short digest of command for the names of state files."""
+    return hashlib.md5(' '.join(command)).hexdigest()[:8]
+
+def cached_result(path, ttl):
+    """ Output cached at path if it is younger than ttl seconds."""
+    now = time.time()
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if now - mtime > ttl:
+        return None
+    out = read_state(path)
+    if out is None:
+        return None
+    logging.debug('using output cached %.1fs ago in %s', now - mtime, path)
+    # access time orders the cache for eviction, whatever the mount options
+    os.utime(path, (now, mtime))
+    return 0, out, ''
+
+def evict(cache_dir, size):
+    """ Remove the least recently used outputs until size are left."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('.') or name.endswith('.lock'):
+            continue
+        try:
+            entries.append((os.stat(os.path.join(cache_dir, name)).st_atime,
+                name))
+        except OSError:
+            pass
+    entries.sort()
+    for atime, name in entries[:max(len(entries) - size, 0)]:
+        logging.debug('evicting %s from the result cache', name)
+        for path in (name, name + '.lock'):
+            try:
+                os.unlink(os.path.join(cache_dir, path))
+            except OSError:
+                pass
+
+def communicate(proc, start_time, timeout, done=None, profile=None):
+    """ Read the output of proc as it arrives until it exits, or until
+    done(lines), called with each batch of new stdout lines, returns True.
+    In that case proc is terminated and treated as successful. The time
+    until the first output and the time reading the rest are added to
+    profile as the remote and transfer phases."""
+    stdout, stderr = proc.stdout.fileno(), proc.stderr.fileno()
+    output = {stdout: [], stderr: []}
+    open_fds = [stdout, stderr]
+    partial = ''
+    stopped = False
+    while open_fds and not stopped:
+        try:
+            timecheck(start_time, timeout, 'waiting for Popen')
+        except NagaExit:
+            reap(proc)
+            raise
+        remaining = start_time + timeout - time.time()
+        for fd in select.select(open_fds, [], [], max(remaining, 0))[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                open_fds.remove(fd)
+                continue
+            if fd == stdout and profile is not None and not output[fd]:
+                profile.mark('remote')
+            output[fd].append(data)
+            if fd == stdout and done is not None:
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                stopped = done(lines)
+    if stopped:
+        logging.debug('parser has all it needs, terminating ssh')
+        proc.terminate()
+    ret = proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+    if profile is not None:
+        profile.mark('transfer')
+    if stopped:
+        ret = 0
+    return ret, ''.join(output[stdout]), ''.join(output[stderr])
+
+def transport(hostname, **kwargs):
+    """ Name of the transport used to reach hostname: the --transport
+    option, or for auto local when hostname is the nagios server itself
+    (and no other login or port is asked for), mux with --multiplex and ssh
+    otherwise."""
+    name = kwargs.get('transport') or 'auto'
+    if name != 'auto':
+        return name
+    if hostname in LOCAL_HOSTS and not [key for key in ('logname', 'port',
+            'key') if key in kwargs]:
+        return 'local'
+    if kwargs.get('multiplex'):
+        return 'mux'
+    return 'ssh'
+
+def transport_command(hostname, timeout, binary, start_time, command,
+        **kwargs):
+    """ Build the shell command line that runs command on hostname over
+    its transport."""
+    name = transport(hostname, **kwargs)
+    if name == 'local':
+        raise NagaExit(3, 'the local transport runs commands without a shell')
+    if name == 'replay':
+        raise NagaExit(3, 'the replay transport only runs single checks')
+    kwargs['multiplex'] = name == 'mux'
+    return ssh_command(hostname, timeout, binary, start_time, command,
+            **kwargs)
+
+def replay_command(hostname, info, **kwargs):
+    """ Command answering with a capture of info from replay_dir instead
+    of running the command on hostname: <info>_<hostname>.txt if there is
+    one, else one of the <info>_*.txt captures chosen by hostname. The
+    replay_latency (varied by up to replay_jitter) and replay_failures
+    fraction of failed connections are simulated."""
+    directory = kwargs.get('replay_dir') or REPLAY_DIR
+    path = os.path.join(directory, '%s_%s.txt' % (info, hostname))
+    if not os.path.exists(path):
+        captures = sorted(glob.glob(os.path.join(directory, '%s_*.txt' %
+            info)))
+        if not captures:
+            raise NagaExit(3, 'no capture of %s in %s' % (info, directory))
+        digest = int(hashlib.md5(hostname).hexdigest()[:8], 16)
+        path = captures[digest % len(captures)]
+    jitter = float(kwargs.get('replay_jitter') or 0)
+    delay = float(kwargs.get('replay_latency') or 0) + random.uniform(
+            -jitter, jitter)
+    command = []
+    if delay > 0:
+        command += ['/bin/sleep', '%.3f' % delay, '&&']
+    if random.random() < float(kwargs.get('replay_failures') or 0):
+        return command + ['exit', str(SSH_FAILURE)]
+    return command + ['/bin/cat', path]
+
+def parse_local(command):
+    """ Split command into a list of (separator, pipeline) steps, each
+    pipeline a list of argument lists, for run_local(). Return None if
+    command uses any other shell syntax (redirections, quoting other than
+    whole single quoted words, variables, subshells), the local transport
+    does not run those."""
+    steps = []
+    separator = None
+    pipeline = [[]]
+    for token in command + [';']:
+        if token in LOCAL_SEPARATORS:
+            if [] in pipeline:
+                return None
+            steps.append((separator, pipeline))
+            separator = token
+            pipeline = [[]]
+        elif token == '|':
+            pipeline.append([])
+        elif (len(token) > 1 and token[0] == "'" and token[-1] == "'" and
+                "'" not in token[1:-1]):
+            pipeline[-1].append(token)
+        elif [char for char in '"\'$`\\<>&(){}' if char in token]:
+            return None
+        else:
+            pipeline[-1].append(token)
+    return steps
+
+def run_local(steps, start_time, timeout):
+    """ Run the steps of parse_local() like /bin/sh would, without ssh
+    and without a shell. The commands in LOCAL_COMMANDS are run in this
+    process, anything else as a child process with its arguments as they
+    are. Return (returncode, stdout, stderr)."""
+    out = []
+    err = []
+    ret = 0
+    for separator, pipeline in steps:
+        if (separator == '&&' and ret != 0) or (separator == '||' and
+                ret == 0):
+            continue
+        data = None
+        for args in pipeline:
+            timecheck(start_time, timeout, 'running locally')
+            name = os.path.basename(args[0])
+            options = [arg for arg in args[1:] if arg.startswith('-')]
+            if name == 'sleep' and len(args) > 1:
+                # never sleep past the timeout
+                args = args[:1] + [str(min(float(args[1]), max(start_time +
+                    timeout - time.time(), 0)))]
+            if name in LOCAL_COMMANDS and not [option for option in options
+                    if option not in LOCAL_COMMANDS[name]]:
+                ret, data, error = globals()['local_' + name](
+                        local_args(args[1:]), data)
+            else:
+                ret, data, error = local_exec(local_args(args), data,
+                        start_time, timeout)
+            err.append(error)
+        out.append(data)
+    return ret, ''.join(out), ''.join(err)
+
+def local_args(args):
+    """ Remove quotes from and expand glob patterns in args."""
+    expanded = []
+    for arg in args:
+        if arg[0] == "'":
+            expanded.append(arg[1:-1])
+        elif is_pattern(arg):
+            expanded += sorted(glob.glob(arg)) or [arg]
+        else:
+            expanded.append(arg)
+    return expanded
+
+def local_exec(args, data, start_time, timeout):
+    """ Run the argument list args (no shell) as a child process with data
+    as its input."""
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, stdin=data is not None and
+                subprocess.PIPE or None)
+    except OSError as exc:
+        # what /bin/sh returns for a command it can not run
+        return 127, '', '%s: %s\n' % (args[0], exc.strerror)
+    if data is None:
+        return communicate(proc, start_time, timeout)
+    out, err = proc.communicate(data)
+    return proc.returncode, out, err
+
+def local_read(path):
+    """ Contents of the file at path, and an error message for cat or
+    grep if it can not be read."""
+    try:
+        with open(path, 'rb') as infile:
+            return infile.read(), ''
+    except IOError as exc:
+        return None, '%s: %s\n' % (path, exc.strerror)
+
+def local_cat(args, data):
+    """ cat [FILE]..."""
+    if not args:
+        return 0, data or '', ''
+    out = []
+    err = []
+    for path in args:
+        text, error = local_read(path)
+        if error:
+            err.append('cat: ' + error)
+        else:
+            out.append(text)
+    return int(bool(err)), ''.join(out), ''.join(err)
+
+def local_echo(args, data):
+    """ echo [STRING]..."""
+    return 0, ' '.join(args) + '\n', ''
+
+def local_sleep(args, data):
+    """ sleep SECONDS"""
+    time.sleep(float(args[0]))
+    return 0, '', ''
+
+def local_exit(args, data):
+    """ exit [N]"""
+    return int((args or ['0'])[0]), '', ''
+
+def remote_payload(command, **kwargs):
+    """ Return the command to run on the remote host and the script to send
+    to its input: with --script command is rendered by remote_script() and
+    run by SCRIPT_COMMAND, otherwise it is run as is with no input."""
+    if not kwargs.get('script'):
+        return command, None
+    script = remote_script(command)
+    if script is None:
+        logging.debug('cannot script %s, running it as is', ' '.join(command))
+        return command, None
+    return SCRIPT_COMMAND, script
+
+def remote_script(command):
+    """ Render command as a POSIX shell script that does the work of cat,
+    echo, grep and wc -l with builtins (read loops, case and printf), so
+    only the other commands, such as sleep, fork on the remote host.
+    Return None if command uses shell syntax parse_local() does not
+    understand."""
+    steps = parse_local(command)
+    if steps is None:
+        return None
+    script = ''
+    for separator, pipeline in steps:
+        if separator is None:
+            script += script_pipeline(pipeline)
+        elif separator == ';':
+            script += '\n' + script_pipeline(pipeline)
+        else:
+            script += ' %s %s' % (separator, script_pipeline(pipeline))
+    return script + '\n'
+
+def script_pipeline(pipeline):
+    """ Shell code running pipeline: a read loop for cat or grep of files
+    filtered by more greps and optionally counted by wc -l, the builtin for
+    echo and exit, the pipeline itself for anything else."""
+    names = [os.path.basename(args[0]) for args in pipeline]
+    if len(pipeline) == 1 and names[0] in ('echo', 'exit'):
+        return ' '.join([names[0]] + pipeline[0][1:])
+    plain = ' | '.join([' '.join(args) for args in pipeline])
+    count = names[-1] == 'wc' and pipeline[-1][1:] == ['-l']
+    if count:
+        pipeline = pipeline[:-1]
+        names = names[:-1]
+    if not pipeline or names[0] not in ('cat', 'grep') or [name for name in
+            names[1:] if name != 'grep']:
+        return plain
+    if names[0] == 'cat':
+        files, greps = pipeline[0][1:], pipeline[1:]
+    else:
+        files, greps = grep_args(pipeline[0])[1:], pipeline
+    patterns = [case_pattern(grep_args(args)[0], '-E' in args)
+            for args in greps]
+    if not files or [args for args in greps[1:] if grep_args(args)[1:]] or (
+            names[0] == 'grep' and len(files) > 1) or None in patterns:
+        return plain
+    body = []
+    if [strip for glob, strip in patterns if strip]:
+        body.append('t=${l#"${l%%[! ]*}"};')
+    for glob, strip in patterns:
+        body.append('case $%s in %s) ;; *) continue;; esac;' % (
+            strip and 't' or 'l', glob))
+    if count:
+        body.append('n=$((n+1));')
+    else:
+        body.append('g=0; printf \'%s\\n\' "$l";')
+    loop = '%s %s done' % (SCRIPT_READ, ' '.join(body))
+    code = ['r=0; g=1; n=0;'] + ['%s < %s || r=1;' % (loop, path)
+            for path in files]
+    if count:
+        code.append('echo $n;')
+    elif greps:
+        code.append('[ $r$g = 00 ];')
+    else:
+        code.append('[ $r = 0 ];')
+    return '{ %s }' % ' '.join(code)
+
+def grep_args(args):
+    """ The pattern and files of the grep command args, or [] if it has
+    options other than -E."""
+    args = [arg for arg in args[1:] if arg != '-E']
+    if not args or [arg for arg in args if arg.startswith('-')]:
+        return []
+    return args
+
+def case_pattern(regex, extended=False):
+    """ Translate a grep regex into a case pattern matching the same lines,
+    and whether leading blanks have to be stripped from the line first.
+    Only the forms naga uses are understood: ^, ^ * and $ anchors, literal
+    text, [...] classes (followed by * for any run of characters) and one
+    (a|b|...) group with -E. Return (None, False) for other regexes."""
+    if regex[:1] == "'":
+        regex = regex[1:-1]
+    strip = False
+    head = '*'
+    if regex.startswith('^ *'):
+        regex, strip, head = regex[3:], True, ''
+    elif regex.startswith('^'):
+        regex, head = regex[1:], ''
+    tail = '*'
+    if regex.endswith('$'):
+        regex, tail = regex[:-1], ''
+    group = extended and re.match(r'^([^()|]*)\(([^()]*)\)([^()|]*)$', regex)
+    if group:
+        alternatives = [group.group(1) + alternative + group.group(3)
+                for alternative in group.group(2).split('|')]
+    else:
+        alternatives = [regex]
+    globs = []
+    for alternative in alternatives:
+        glob = ''
+        literal = ''
+        for token in re.findall(r'\[\^?[^]]*\]\*?|\.\*?|.', alternative):
+            if token.startswith('[') and len(token) == 3 and token[1] != '^':
+                literal += token[1]
+                continue
+            if token.endswith('*') and len(token) > 1:
+                glob += literal and "'%s'" % literal
+                glob, literal = glob + '*', ''
+            elif token == '.':
+                glob += literal and "'%s'" % literal
+                glob, literal = glob + '?', ''
+            elif token.startswith('['):
+                glob += literal and "'%s'" % literal
+                glob, literal = glob + token.replace('[^', '[!'), ''
+            elif token in '*+?{}\\$^' or (extended and token in '()|'):
+                return None, False
+            else:
+                literal += token
+        globs.append(head + glob + (literal and "'%s'" % literal) + tail)
+    return '|'.join(globs), strip
+
+def ssh_command(hostname, timeout, binary, start_time, command, **kwargs):
+    """ Build the shell command line that runs command on hostname."""
     cmd1 = [binary]
     if 'logname' in kwargs:
         user = kwargs['logname']
@@ -117,38 +985,233 @@ def connect(hostname, info, timeout, binary, start_time=None, **kwargs):
     if 'key' in kwargs:
         cmd1 += ['-i', kwargs['key']]
     if 'port' in kwargs:
-        hostname += str(kwargs['port'])
-    cmd1.append('%s@%s' % (user, hostname))
-    cmd = cmd1 + ['"'] + INFO_CHOICES[info] + ['"']
-    logging.debug('about to Popen %s', ' '.join(cmd))
-    proc = subprocess.Popen(' '.join(cmd), shell=True, stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE)
-    while proc.poll() is None:
-        timecheck(start_time, timeout, 'waiting for Popen', proc)
-        sleep = min(float(timeout)/10, 1)
-        logging.debug('waiting for proc.poll(), sleeping for %s seconds', 
-                sleep)
-        time.sleep(sleep)
-    ret = proc.returncode
-    out = proc.stdout.read()
-    err = proc.stderr.read()
-    return ret, out, err
+        cmd1 += ['-p', str(kwargs['port'])]
+    if kwargs.get('compress'):
+        cmd1.append('-C')
+    target = '%s@%s' % (user, hostname)
+    if kwargs.get('multiplex'):
+        cmd1 += multiplex(cmd1, target, timeout, start_time, **kwargs)
+    cmd1.append(target)
+    return ' '.join(cmd1 + ['"'] + command + ['"'])
+
+def control_path(control_dir, target, port=None):
+    """ Path of the control socket for target (user@host) on port."""
+    if port is None:
+        port = 22
+    return os.path.join(control_dir, '%s:%s' % (target, port))
+
+def socket_alive(path):
+    """ Check whether a master is listening on the control socket at path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def prune_masters(control_dir):
+    """ Remove stale control sockets, return the paths of the live ones."""
+    live = []
+    for name in os.listdir(control_dir):
+        path = os.path.join(control_dir, name)
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            continue
+        if not stat.S_ISSOCK(mode):
+            continue
+        if socket_alive(path):
+            live.append(path)
+        else:
+            logging.debug('removing stale control socket %s', path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return live
+
+def multiplex(cmd1, target, timeout, start_time, **kwargs):
+    """ Make sure a master connection to target exists, return the ssh
+    options needed to use it (or none if no master could be used). With
+    background_master a missing master is started without waiting for it
+    and none are returned until it is up, see poll_masters()."""
+    control_dir = kwargs.get('control_dir', CONTROL_DIR)
+    if not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0700)
+    path = control_path(control_dir, target, kwargs.get('port'))
+    opts = ['-o', 'ControlPath=%s' % path]
+    if socket_alive(path):
+        logging.debug('reusing master connection %s', path)
+        return opts + ['-o', 'ControlMaster=no']
+    background = kwargs.get('background_master')
+    if background and path in STARTING_MASTERS:
+        return []
+    # Only one naga process should start the master for a given host.
+    lock = open(path + '.lock', 'w')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (background and fcntl.LOCK_NB
+                or 0))
+        except IOError:
+            # another naga is starting it
+            return []
+        if socket_alive(path):
+            return opts + ['-o', 'ControlMaster=no']
+        live = prune_masters(control_dir)
+        if len(live) >= int(kwargs.get('max_masters', MAX_MASTERS)):
+            logging.info('%s masters open, not starting one for %s',
+                    len(live), target)
+            return []
+        persist = kwargs.get('control_persist', CONTROL_PERSIST)
+        cmd = cmd1 + opts + ['-o', 'ControlMaster=yes', '-o',
+                'ControlPersist=%s' % persist, '-N', '-f', target]
+        logging.debug('starting master connection %s', ' '.join(cmd))
+        devnull = open(os.devnull, 'r+')
+        try:
+            # the master must not inherit (and keep holding) the lock
+            proc = subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                    stderr=devnull, close_fds=True)
+            if background:
+                # the lock is kept until poll_masters() reaps it
+                STARTING_MASTERS[path] = (proc, lock, start_time + timeout)
+                lock = None
+                return []
+            # ssh -f backgrounds itself once authenticated
+            while proc.poll() is None:
+                try:
+                    timecheck(start_time, timeout, 'starting master')
+                except NagaExit:
+                    reap(proc)
+                    raise
+                time.sleep(min(float(timeout)/100, 0.1))
+        finally:
+            devnull.close()
+    finally:
+        if lock is not None:
+            lock.close()
+    if proc.returncode != 0 or not socket_alive(path):
+        logging.info('could not start master for %s (%s)', target,
+                proc.returncode)
+        return []
+    return opts + ['-o', 'ControlMaster=no']
+
+def poll_masters():
+    """ Reap the masters started by multiplex() in the background that are
+    up, failed or ran out of time, and release their locks."""
+    for path, (proc, lock, until) in STARTING_MASTERS.items():
+        if proc.poll() is None and time.time() < until:
+            continue
+        reap(proc)
+        lock.close()
+        del STARTING_MASTERS[path]
+        if proc.returncode != 0 or not socket_alive(path):
+            logging.info('could not start master %s (%s)', path,
+                    proc.returncode)
 
 def memory(out, **kwargs):
-    """Get information about memory usage."""
+    """ Get memory usage (in MB) from /proc/meminfo, or from free -m on
+    hosts without it. The level is based on what -s selects: available (the
+    default, memory that can not be handed out without swapping), used
+    (excluding buffers and cache, as free -m used to show), swap or
+    committed (of the commit limit)."""
+    if 'MemTotal:' not in out:
+        return free(out, **kwargs)
+    fields = {}
+    for line in out.splitlines():
+        key, colon, value = line.partition(':')
+        if colon:
+            fields[key] = value.split()[0]
+    mega = lambda key: int(fields.get(key, 0)) / 1024.0
+    total = mega('MemTotal')
+    unused = mega('MemFree')
+    buff = mega('Buffers')
+    cache = mega('Cached') + mega('SReclaimable')
+    used = total - unused - buff - cache
+    if 'MemAvailable' in fields:
+        available = mega('MemAvailable')
+    else:
+        # kernels before 3.14 do not estimate it
+        available = unused + buff + cache
+    swap_used = mega('SwapTotal') - mega('SwapFree')
+    # HugePages_ are counted in pages
+    hugepage = mega('Hugepagesize')
+    detail = [
+            ('total', total),
+            ('used', used),
+            ('free', unused),
+            ('shared', mega('Shmem')),
+            ('buff', buff),
+            ('cache', cache),
+            ('available', available),
+            ('swap_total', mega('SwapTotal')),
+            ('swap_used', swap_used),
+            ('dirty', mega('Dirty')),
+            ('writeback', mega('Writeback')),
+            ('slab', mega('Slab')),
+            ('slab_unreclaim', mega('SUnreclaim')),
+            ('hugepages', int(fields.get('HugePages_Total', 0)) * hugepage),
+            ('hugepages_free', int(fields.get('HugePages_Free', 0)) *
+                hugepage),
+            ('committed', mega('Committed_AS')),
+        ]
+    level, extra = memory_level({'available': (total - available, total),
+        'used': (used, total), 'swap': (swap_used, mega('SwapTotal')),
+        'committed': (mega('Committed_AS'), mega('CommitLimit'))}, **kwargs)
+    return level, detail, extra
+
+def free(out, **kwargs):
+    """ Get memory usage from free -m, the -/+ buffers/cache row of older
+    procps or the available column of newer ones."""
     lines = out.splitlines()
-    line1 = lines[1].split()
-    line2 = lines[2].split()
+    rows = {}
+    for line in lines[1:]:
+        name, colon, values = line.rpartition(':')
+        rows[name.strip()] = [int(value) for value in values.split()]
+    mem = dict(zip(lines[0].split(), rows['Mem']))
+    total = mem['total']
+    free_mb = mem['free']
+    if '-/+ buffers/cache' in rows:
+        # free has always been reported from this row on older procps
+        used, free_mb = rows['-/+ buffers/cache'][:2]
+    else:
+        used = total - mem['free'] - mem.get('buffers', 0) - mem.get(
+                'cached', mem.get('buff/cache', 0))
     detail = [
-            ('total' , int(line1[1])),
-            ('used'  , int(line2[2])),
-            ('free'  , int(line2[3])),
-            ('shared', int(line1[4])),
-            ('buff'  , int(line1[5])),
-            ('cache' , int(line1[6])),
+            ('total' , total),
+            ('used'  , used),
+            ('free'  , free_mb),
+            ('shared', mem['shared']),
         ]
-    level = float(detail[1][1]) / detail[0][1]
-    return level, detail, ''
+    if 'buffers' in mem:
+        detail += [('buff', mem['buffers']), ('cache', mem['cached'])]
+    else:
+        detail.append(('cache', mem['buff/cache']))
+    bases = {'available': (used, total), 'used': (used, total)}
+    if 'available' in mem:
+        detail.append(('available', mem['available']))
+        bases['available'] = (total - mem['available'], total)
+    if 'Swap' in rows:
+        swap_total, swap_used = rows['Swap'][:2]
+        detail += [('swap_total', swap_total), ('swap_used', swap_used)]
+        bases['swap'] = (swap_used, swap_total)
+    level, extra = memory_level(bases, **kwargs)
+    return level, detail, extra
+
+def memory_level(bases, **kwargs):
+    """ Level and description of the basis -s selects (default
+    MEMORY_BASIS) from bases, a dict of basis: (used, total)."""
+    basis = kwargs.get('special') or MEMORY_BASIS
+    if basis not in MEMORY_BASES:
+        raise NagaExit(3, 'invalid memory basis %s (%s)' % (basis,
+            ', '.join(sorted(MEMORY_BASES))))
+    if basis not in bases:
+        raise NagaExit(3, 'memory basis %s needs /proc/meminfo' % basis)
+    used, total = bases[basis]
+    if not total:
+        return 0.0, MEMORY_BASES[basis]
+    return float(used) / total, MEMORY_BASES[basis]
 
 def load(out, **kwargs):
     """Get load information."""
@@ -169,6 +1232,8 @@ def cpu(out, **kwargs):
         cpu_n = kwargs['special']
     else: 
         cpu_n = ''
+    if cpu_n in ('hottest', 'imbalance'):
+        return cpu_cores(out, cpu_n, **kwargs)
     if cpu_n == '': 
         offset = 0
     elif cpu_n.startswith('cpu') and cpu_n in out:
@@ -199,17 +1264,150 @@ def cpu(out, **kwargs):
         ]
     return detail[0][1]/100, detail, cpu_n
 
+def cpu_cores(out, mode, **kwargs):
+    """ Get the usage of every core. The level is that of the hottest
+    core, or for the imbalance mode how far it is above the mean."""
+    names, busy = core_usage(out)
+    mean = sum(busy) / len(busy)
+    order = sorted(xrange(len(busy)), key=busy.__getitem__, reverse=True)
+    hottest = busy[order[0]]
+    detail = [('cpu', mean*100, '%'), ('imbalance', (hottest-mean)*100, '%')]
+    detail += [(name, usage*100, '%') for name, usage in zip(names, busy)]
+    top = ', '.join(['%s (%s%%)' % (names[i], format_num(busy[i]*100))
+        for i in order[:int(kwargs.get('top_cores', TOP_CORES))]])
+    extra = 'hottest %s, mean %s%%' % (top, format_num(mean*100))
+    if mode == 'imbalance':
+        return hottest - mean, detail, 'imbalance, ' + extra
+    return hottest, detail, 'on ' + extra
+
+def core_usage(out):
+    """ Return the names of the cores in the two reads of /proc/stat in
+    out and the fraction of the time between them each was busy. Uses
+    numpy when it is installed."""
+    rows = [line.split() for line in out.splitlines()
+            if line.startswith('cpu') and line[3:4].isdigit()]
+    half = len(rows) / 2
+    names = [row[0] for row in rows[:half]]
+    if not names or names != [row[0] for row in rows[half:]]:
+        raise NagaExit(3, 'successive calls of /proc/stat were too different')
+    numpy = numpy_module()
+    if numpy is None:
+        return names, core_busy(rows[:half], rows[half:])
+    return names, core_busy_numpy(numpy, rows[:half], rows[half:])
+
+def numpy_module():
+    """ The numpy module, None if it is not installed. Only the first
+    call looks for it (and only checks that need it pay for importing it)."""
+    global numpy_module
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    numpy_module = lambda: numpy
+    return numpy
+
+def core_busy(first, second):
+    """ Busy fraction of each core from its first and second /proc/stat
+    row (name, user, nice, system, idle, iowait, irq, softirq, steal...).
+    Guest time is already counted in user and nice."""
+    busy = []
+    for row0, row1 in zip(first, second):
+        delta = [int(b) - int(a) for a, b in zip(row0[1:9], row1[1:9])]
+        total = sum(delta)
+        busy.append(float(total - delta[3]) / (total or 1))
+    return busy
+
+def core_busy_numpy(numpy, first, second):
+    """ core_busy() for all cores at once with numpy."""
+    width = min([len(row) for row in first + second] + [9])
+    data = numpy.array([row[1:width] for row in first + second],
+            dtype=numpy.int64)
+    delta = data[len(first):] - data[:len(first)]
+    total = delta.sum(axis=1)
+    busy = (total - delta[:, 3]) / numpy.maximum(total, 1).astype(float)
+    return busy.tolist()
+
 def disk(out, **kwargs):
-    """ Get disk io."""
-    mega = 1024*1024
-    if 'block' in kwargs:
-        block = kwargs['block']
+    """ Get disk io from two reads of /proc/diskstats, or from vmstat on
+    hosts without it."""
+    if DIVIDE not in out:
+        return vmstat(out, **kwargs)
+    samples = []
+    for chunk in out.split(DIVIDE):
+        lines = chunk.strip().splitlines()
+        uptime = None
+        if lines and len(lines[0].split()) == 2:
+            uptime = float(lines.pop(0).split()[0])
+        stats = {}
+        for line in lines:
+            # major minor name reads merged sectors ms writes merged sectors
+            # ms in_progress ms_io weighted_ms [discards and flushes], only
+            # the counters of the devices reported on are converted
+            parts = line.split(None, 3)
+            if len(parts) == 4:
+                stats[parts[2]] = parts[3]
+        samples.append((uptime, stats))
+    (up0, first), (up1, second) = samples[-2:]
+    if 'elapsed' in kwargs:
+        elapsed = float(kwargs['elapsed'])
+    elif up0 is not None and up1 is not None and up1 > up0:
+        elapsed = up1 - up0
     else:
-        block = 4096
-    lines = out.splitlines()
-    mb_in  = int(lines[-1].split()[8])*block/mega
-    mb_out = int(lines[-1].split()[8])*block/mega
-    desc = 'in_persec=%sMB;out_persec=%sMB' % (mb_in, mb_out)
+        elapsed = float(kwargs.get('disk_window', DISK_WINDOW))
+    names = [name for name in second if name in first]
+    if 'special' in kwargs:
+        targets = match_targets(kwargs['special'], dict.fromkeys(names))
+        if not targets:
+            raise NagaExit(3, 'invalid disk %s' % kwargs['special'])
+    else:
+        targets = sorted(whole_disks(names))
+        if not targets:
+            raise NagaExit(3, 'could not find a disk')
+    mega = 1024.0*1024
+    desc = []
+    levels = []
+    for name in targets:
+        delta = [counter_delta(int(a), int(b)) for a, b in zip(
+            first[name].split()[:11], second[name].split()[:11])]
+        if len(delta) < 11:
+            # partitions only have four counters on old kernels
+            raise NagaExit(3, 'no io statistics for disk %s' % name)
+        reads, writes = delta[0], delta[4]
+        mb_read = delta[2]*SECTOR/mega/elapsed
+        mb_write = delta[6]*SECTOR/mega/elapsed
+        ios = reads + writes
+        await_ms = float(delta[3] + delta[7])/ios if ios else 0.0
+        util = min(delta[9]/(elapsed*1000), 1.0)
+        desc += [(name+'_read', mb_read), (name+'_write', mb_write),
+                (name+'_iops', ios/elapsed), (name+'_await', await_ms),
+                (name+'_util', util*100)]
+        levels.append((mb_read + mb_write, name))
+    level, extra = worst_target(levels)
+    return level, desc, extra
+
+def whole_disks(names):
+    """ The names of /proc/diskstats that are disks rather than partitions
+    of one (sda1, nvme0n1p1, mmcblk0p1) or loop and ram devices."""
+    index = set(names)
+    disks = []
+    for name in names:
+        if name.startswith('loop') or name.startswith('ram'):
+            continue
+        base = name.rstrip('0123456789')
+        if base != name and (base in index or (base.endswith('p') and
+                base[:-1] in index)):
+            continue
+        disks.append(name)
+    return disks
+
+def vmstat(out, **kwargs):
+    """ Get disk io from the bi and bo columns of vmstat."""
+    mega = 1024.0*1024
+    block = int(kwargs.get('block', 1024))
+    parts = out.splitlines()[-1].split()
+    mb_in  = int(parts[8])*block/mega
+    mb_out = int(parts[9])*block/mega
+    desc = [('in_persec', mb_in, 'MB'), ('out_persec', mb_out, 'MB')]
     return mb_in+mb_out, desc, ''
 
 def filesystem(out, **kwargs):
@@ -236,51 +1434,351 @@ def filesystem(out, **kwargs):
         fsys = '/'
     else:
         fsys = kwargs['special']
-    if not fsys in systems:
+    targets = match_targets(fsys, systems)
+    if not targets:
         raise NagaExit(3, 'could not find filesystem %s | %s' % (fsys, out))
-    fs_info = systems[fsys]
-    
+    levels = []
+    for name in targets:
+        fs_info = systems[name]
+        if fs_info[1] > 0:
+            levels.append((float(fs_info[2]) / fs_info[1], name))
+        else:
+            levels.append((0.0, name))
     detail = []
+    matched = set(targets)
     for name, info in systems.items():
-        if info[0].startswith('/dev/') or name == '/':
-            data = [str(i) for i in [info[1], '', '', 0, info[2]]]
-            detail.append(("'"+name+"'", ';'.join(data)))
+        if info[0].startswith('/dev/') or name == '/' or name in matched:
+            # value;warn;crit;min;max, the value first so --export finds it
+            detail.append(("'"+name+"'", info[1], '', '', '', 0, info[2]))
 
-    return float(fs_info[2]) / fs_info[1], detail, 'on %s' % fsys
+    level, extra = worst_target(levels, '%', 100)
+    return level, detail, extra
+
+def worst_target(levels, unit='MB/s', scale=1):
+    """ The worst of the (level, target) levels of a check of several
+    targets and the extra text naming it, or all targets worst first with
+    their level (times scale, in unit) when there are several."""
+    levels.sort(reverse=True)
+    if len(levels) == 1:
+        return levels[0][0], 'on %s' % levels[0][1]
+    return levels[0][0], 'on %s' % ', '.join(['%s (%s%s)' % (name,
+        format_num(level*scale), unit) for level, name in levels])
+
+def match_targets(special, names):
+    """ Return the names matching the comma separated list of names and
+    glob patterns in special, in the order they are given. names should be
+    indexed (a dict or set) so exact names are found without a scan."""
+    matched = []
+    seen = set()
+    for pattern in special.split(','):
+        pattern = pattern.strip()
+        if pattern in names:
+            found = [pattern]
+        elif is_pattern(pattern):
+            found = sorted(fnmatch.filter(names, pattern))
+        else:
+            found = []
+        for name in found:
+            if name not in seen:
+                seen.add(name)
+                matched.append(name)
+    return matched
+
+def is_pattern(special):
+    """ Whether special contains glob characters."""
+    return '*' in special or '?' in special or '[' in special
+
+def filesystem_stream(**kwargs):
+    """ Return a function telling connect() when df has printed the
+    requested filesystems, or None when all of its output is needed."""
+    if not 'special' in kwargs or is_pattern(kwargs['special']):
+        return None
+    wanted = set([name.strip() for name in kwargs['special'].split(',')])
+    def done(lines):
+        for line in lines:
+            parts = line.split()
+            if parts:
+                wanted.discard(parts[-1])
+        return not wanted
+    return done
 
 def network(out, **kwargs):
-    """ Get network usage."""
+    """ Get network usage from two reads of /proc/net/dev, or of the
+    counters in /sys/class/net (as read by earlier versions)."""
+    head = out.split(DIVIDE)[0]
+    if ':' in head or '|' in head:
+        return net_dev(out, **kwargs)
     if_default = ['eth', 'wlan', 'wwan']
     ifaces = out.split(DIVIDE)[0].split()
     data   = out.split(DIVIDE)[1].split()
-    iface = None
+    index = dict([(name, i) for i, name in enumerate(ifaces)])
+    targets = []
     if 'special' in kwargs:
-        if kwargs['special'] in ifaces:
-            iface = kwargs['special']
-        else:
+        targets = match_targets(kwargs['special'], index)
+        if not targets:
             raise NagaExit(3, 'invalid interface %s' % kwargs['special'])
     else:
         for i in if_default:
             for j in ifaces:
-                if j.startswith(i) and data[ifaces.index(j)] != 0:
-                    iface = j
+                if j.startswith(i) and data[index[j]] != 0:
+                    targets = [j]
                     break
-            if iface is not None:
+            if targets:
                 break
+        if not targets:
+            raise NagaExit(3, 'could not find a default interface')
     result = [data[i:i+len(ifaces)] for i in xrange(0, len(data), len(ifaces))]
-    rx_diff = [sum((int(b), -int(a))) for a, b in zip(result[0], result[2])]
-    tx_diff = [sum((int(b), -int(a))) for a, b in zip(result[1], result[3])]
+    rx_diff = [counter_delta(int(a), int(b)) for a, b in zip(result[0], result[2])]
+    tx_diff = [counter_delta(int(a), int(b)) for a, b in zip(result[1], result[3])]
     desc = []
     for i in xrange(len(ifaces)):
         desc.append((ifaces[i]+'_rx', rx_diff[i]))
         desc.append((ifaces[i]+'_tx', tx_diff[i]))
-    i = ifaces.index(iface)
-    level = (rx_diff[i]+tx_diff[i])/1024.0/1024
-    return level, desc, 'on %s' % iface
+    levels = []
+    for iface in targets:
+        i = index[iface]
+        level = (rx_diff[i]+tx_diff[i])/1024.0/1024
+        if 'elapsed' in kwargs:
+            level /= kwargs['elapsed']
+        levels.append((level, iface))
+    level, extra = worst_target(levels)
+    return level, desc, extra
+
+def net_dev(out, **kwargs):
+    """ Get network usage from two reads of /proc/net/dev (each optionally
+    preceded by /proc/uptime). Rates are per second, the level is the
+    MB/s of the busiest target interface."""
+    (up0, first, names0), (up1, second, names) = [read_net_dev(chunk)
+            for chunk in out.split(DIVIDE)[-2:]]
+    if 'elapsed' in kwargs:
+        elapsed = float(kwargs['elapsed'])
+    elif up0 is not None and up1 is not None and up1 > up0:
+        elapsed = up1 - up0
+    else:
+        elapsed = float(kwargs.get('network_window', NETWORK_WINDOW))
+    names = [name for name in names if name in first]
+    index = dict.fromkeys(names)
+    include, exclude = split_patterns(kwargs.get('special') or '')
+    reported = names
+    if include:
+        reported = match_targets(include, index)
+    if exclude:
+        excluded = set(match_targets(exclude, index))
+        reported = [name for name in reported if name not in excluded]
+    if include or exclude:
+        targets = reported
+        if not targets:
+            raise NagaExit(3, 'invalid interface %s' % kwargs['special'])
+    else:
+        targets = []
+        for prefix in NET_DEFAULT:
+            targets = [name for name in sorted(names)
+                    if name.startswith(prefix)][:1]
+            if targets:
+                break
+        if not targets:
+            raise NagaExit(3, 'could not find a default interface')
+    mega = 1024.0*1024
+    desc = []
+    rates = {}
+    for name in reported:
+        # rx bytes packets errs drop fifo frame compressed multicast, then
+        # tx bytes packets errs drop fifo colls carrier compressed
+        delta = [counter_delta(int(a), int(b)) / elapsed for a, b in zip(
+            first[name].split(), second[name].split())]
+        rates[name] = delta[0] + delta[8]
+        desc += [(name+'_rx', delta[0]), (name+'_tx', delta[8]),
+                (name+'_rx_packets', delta[1]), (name+'_tx_packets', delta[9]),
+                (name+'_rx_errs', delta[2]), (name+'_tx_errs', delta[10]),
+                (name+'_rx_drop', delta[3]), (name+'_tx_drop', delta[11])]
+    levels = [(rates[name]/mega, name) for name in targets]
+    level, extra = worst_target(levels)
+    return level, desc, extra
+
+def read_net_dev(chunk):
+    """ Return the uptime (None if not read), the counters of each
+    interface (unconverted) and the interface names in the order read,
+    from one read of /proc/net/dev."""
+    uptime = None
+    counters = {}
+    names = []
+    for line in chunk.splitlines():
+        name, colon, values = line.partition(':')
+        if colon:
+            name = name.strip()
+            counters[name] = values
+            names.append(name)
+        elif uptime is None and not names and len(line.split()) == 2:
+            uptime = float(line.split()[0])
+    return uptime, counters, names
+
+def split_patterns(special):
+    """ Split the comma separated patterns in special into those including
+    and those excluding (given as !pattern) names, both comma separated.
+    """
+    patterns = [pattern.strip() for pattern in special.split(',')
+            if pattern.strip()]
+    return (','.join([p for p in patterns if not p.startswith('!')]),
+            ','.join([p[1:] for p in patterns if p.startswith('!')]))
+
+def counter_delta(first, second):
+    """ Difference between two readings of a counter that may have wrapped
+    around at 32 or 64 bits."""
+    if second >= first:
+        return second - first
+    if first < 2**32:
+        return second + 2**32 - first
+    return second + 2**64 - first
+
+def counters(hostname, info, timeout, binary, start, **kwargs):
+    """ Read the counters for info once and pair them with the sample the
+    previous check stored. Without a stored sample of at most
+    counter_max_age seconds the counters are read twice, sleeping in
+    between as usual, in the same session. Should the stored sample still
+    not fit (too recent, host rebooted, cpus or interfaces changed) a second
+    read is made after sleeping.
+    Return the output the parser for info expects and the seconds elapsed
+    between the two samples."""
+    command = counter_command(info, **kwargs)
+    # checks reading different interfaces each keep their own sample
+    path = state_file(kwargs.get('state_dir', STATE_DIR), 'counters',
+            hostname, info, command_digest(command))
+    max_age = float(kwargs.get('counter_max_age', COUNTER_MAX_AGE))
+    sleep = COUNTER_SLEEP[info]
+    if info == 'disk':
+        sleep = kwargs.get('disk_window', sleep)
+    stored = read_state(path)
+    if stored is not None and time.time() - os.path.getmtime(path) > max_age:
+        stored = None
+    read = command
+    if stored is None:
+        logging.debug('no recent %s sample, sampling twice', info)
+        read = command + ['&&', '/bin/sleep', str(sleep), '&&'] + command
+    out = connect(hostname, info, timeout, binary, start, command=read,
+            **kwargs)
+    if out[0] != 0:
+        return out, None
+    samples = split_samples(info, stored or '') + split_samples(info, out[1])
+    try:
+        combined, elapsed = pair_samples(info, samples, max_age, **kwargs)
+    except ValueError as exc:
+        if stored is None:
+            raise NagaExit(3, 'could not sample %s counters: %s' % (info, exc))
+        logging.debug('sampling %s again: %s', info, exc)
+        out = connect(hostname, info, timeout, binary, start,
+                command=['/bin/sleep', str(sleep), '&&'] + command, **kwargs)
+        if out[0] != 0:
+            return out, None
+        samples = samples[-1:] + split_samples(info, out[1])
+        try:
+            combined, elapsed = pair_samples(info, samples, **kwargs)
+        except ValueError as exc:
+            raise NagaExit(3, 'could not sample %s counters: %s' % (info, exc))
+    write_state(path, '%s\n%s\n%s' % ((SAMPLE_DIVIDE,) + samples[-1]))
+    return (out[0], combined, out[2]), elapsed
+
+def pair_samples(info, samples, max_age=None, **kwargs):
+    """ Combine the last two (uptime, counters) samples, return the output
+    the parser for info expects and the seconds between them. Raise
+    ValueError if they can not be paired or (with max_age) are not between
+    COUNTER_MIN_AGE and max_age seconds apart."""
+    if len(samples) < 2:
+        raise ValueError('no previous sample')
+    (up0, first), (up1, second) = samples[-2:]
+    elapsed = up1 - up0
+    if max_age is not None and not COUNTER_MIN_AGE <= elapsed <= max_age:
+        raise ValueError('previous sample is %ss old' % elapsed)
+    return combine_counters(info, first, second, kwargs.get('special')), \
+            elapsed
+
+def counter_command(info, **kwargs):
+    """ Command taking one sample of the counters for info."""
+    if info == 'network' and kwargs.get('special'):
+        read = network_read(kwargs['special'])
+    else:
+        read = COUNTER_CHOICES[info]
+    return ['/bin/echo', SAMPLE_DIVIDE, '&&', '/bin/cat', '/proc/uptime',
+            '&&'] + read
+
+def split_samples(info, out):
+    """ Split counter output into a list of (uptime, counters) samples,
+    keeping only the lines of counters that are needed."""
+    samples = []
+    for chunk in out.split(SAMPLE_DIVIDE + '\n')[1:]:
+        uptime, _, text = chunk.partition('\n')
+        if info in COUNTER_KEEP:
+            text = ''.join([line for line in text.splitlines(True)
+                if line.startswith(COUNTER_KEEP[info])])
+        samples.append((float(uptime.split()[0]), text))
+    return samples
+
+def combine_counters(info, first, second, special=None):
+    """ Join two samples into the output the parser for info expects.
+    Raise ValueError if they can not be compared, e.g. when an interface
+    special includes is missing from either of them."""
+    if info == 'network':
+        include = split_patterns(special or '')[0]
+        for sample in (first, second):
+            names = set(read_net_dev(sample)[1])
+            for pattern in include and include.split(',') or []:
+                if not match_targets(pattern, names):
+                    raise ValueError('no interface %s' % pattern)
+    if info in ('disk', 'network'):
+        # the parsers only compare the devices found in both samples
+        return first + DIVIDE + '\n' + second
+    if len(first.splitlines()) != len(second.splitlines()):
+        raise ValueError('counters changed')
+    return first + second
+
+def state_file(state_dir, kind, *parts):
+    """ Path of the state file of the given kind for parts (e.g. host,
+    info), creating its directory if needed."""
+    directory = os.path.join(state_dir, kind)
+    try:
+        os.makedirs(directory, 0700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    name = '_'.join([str(part).replace('/', '%') for part in parts])
+    return os.path.join(directory, name)
+
+def read_state(path):
+    """ Contents of the state file at path, None if there is none."""
+    try:
+        with open(path, 'rb') as state:
+            return state.read()
+    except IOError:
+        return None
+
+def wait_lock(lock, start_time, timeout, kind):
+    """ Take an exclusive flock of the open file lock, retrying until the
+    timeout runs out."""
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except IOError:
+            timecheck(start_time, timeout, 'waiting for %s lock' % kind)
+            time.sleep(0.05)
+
+def write_state(path, data):
+    """ Replace the state file at path with data. The file is renamed
+    into place so concurrent readers and writers never see partial data."""
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmp, path)
 
 def finish(info, level, detail, extra, **kwargs):
     """ Exit with correct status and message."""
-    unit = INFO_UNITS[info]
+    raise NagaExit(*evaluate(info, level, detail, extra, **kwargs))
+
+def evaluate(info, level, detail, extra, **kwargs):
+    """ Compare level against thresholds, return status, message and
+    perfdata."""
+    unit = kwargs.get('unit', INFO_UNITS[info])
     if unit == '%':
         converted = format_num(level*100)
     else:
@@ -288,26 +1786,416 @@ def finish(info, level, detail, extra, **kwargs):
     if 'warn' in kwargs and kwargs['warn'] is not None:
         warn = kwargs['warn']
     else:
-        warn = INFO_LEVELS[info][0]
+        warn = kwargs.get('levels', INFO_LEVELS[info])[0]
     if 'crit' in kwargs and kwargs['crit'] is not None:
         crit = kwargs['crit']
     else:
-        crit = INFO_LEVELS[info][1]
+        crit = kwargs.get('levels', INFO_LEVELS[info])[1]
     perfdata = build_perfdata(detail)
     if warn >= crit:
-        raise NagaExit(1, 'warn (%s) > crit (%s) for %s' % (warn, crit,
-                info), perfdata)
+        return (1, 'warn (%s) > crit (%s) for %s' % (warn, crit, info),
+                perfdata)
     if level < warn and level < crit:
-        raise NagaExit(0, '%s usage is %s%s %s' % (info, converted, unit,
-            extra), perfdata)
+        return (0, '%s usage is %s%s %s' % (info, converted, unit, extra),
+                perfdata)
     if level >= warn and level < crit:
-        raise NagaExit(1, '%s usage is high %s%s %s' % (info, converted,
-                unit, extra), perfdata)
+        return (1, '%s usage is high %s%s %s' % (info, converted, unit,
+                extra), perfdata)
     if level >= crit:
-        raise NagaExit(2, '%s usage is critical %s%s %s' % (info,
-                converted, unit, extra), perfdata)
+        return (2, '%s usage is critical %s%s %s' % (info, converted, unit,
+                extra), perfdata)
     else:
-        raise NagaExit(3, 'Unknown: no conditions were met', desc=perfdata)
+        return 3, 'Unknown: no conditions were met', perfdata
+
+def worst(statuses):
+    """ Return the most severe of the given nagios statuses."""
+    return max(statuses, key=STATUS_ORDER.index)
+
+def batch_command(checks):
+    """ Build one remote command running each (info, special) check, every
+    section of output is preceded by a BATCH_DIVIDE marker line."""
+    cmd = []
+    for info, special in checks:
+        if cmd:
+            cmd.append(';')
+        cmd += ['/bin/echo', '%s_%s' % (BATCH_DIVIDE, info), '&&']
+        cmd += build_command(info, special=special)
+    return cmd
+
+def split_batch(out):
+    """ Split the output of a batch command into a dict of info: output."""
+    sections = {}
+    info = None
+    for line in out.splitlines(True):
+        if line.startswith(BATCH_DIVIDE + '_'):
+            info = line.strip()[len(BATCH_DIVIDE)+1:]
+            sections[info] = ''
+        elif info is not None:
+            sections[info] += line
+    return sections
+
+def parse_batch(batch):
+    """ Parse the --batch argument into a list of (info, special)."""
+    if batch == 'all':
+        return [(info, None) for info in sorted(INFO_CHOICES)]
+    checks = []
+    for item in batch.split(','):
+        info, _, special = item.strip().partition(':')
+        if info not in INFO_CHOICES:
+            raise NagaExit(3, 'invalid info type in batch: %s' % info)
+        checks.append((info, special or None))
+    return checks
+
+def run_batch(hostname, checks, timeout, binary, start, **kwargs):
+    """ Run several checks over one ssh session, return a list of
+    (info, status, message, perfdata) for each of them."""
+    warn = kwargs.pop('warn', None)
+    crit = kwargs.pop('crit', None)
+    # every check has its own special (or none) in checks, -s is not used
+    kwargs.pop('special', None)
+    out = fetch(hostname, 'batch', timeout, binary, start,
+            command=batch_command(checks), **kwargs)
+    logging.debug('stdout of batch command: %s', out[1])
+    timecheck(start, timeout, 'after running connect()')
+    if out[0] == SSH_FAILURE:
+        raise NagaExit(3, 'ssh command returncode %s' % out[0],
+                'out=%s;err=%s ' % out[1:])
+    sections = split_batch(out[1])
+    results = []
+    for info, special in checks:
+        opts = dict(kwargs)
+        if special is not None:
+            opts['special'] = special
+        if info not in sections:
+            results.append((info, 3, 'no output for %s' % info, None))
+            continue
+        results.append((info,) + tuple(process(info, sections[info],
+            warn=warn, crit=crit, host=hostname, **opts)))
+    return results
+
+def process(info, out, warn=None, crit=None, host=None, **kwargs):
+    """ Parse out (of host) with the parser for info and evaluate the
+    result, return status, message and perfdata instead of exiting."""
+    try:
+        level, detail, extra = globals()[info](out, **kwargs)
+        if host is not None and 'exporter' in kwargs:
+            kwargs['exporter'].add(host, info, detail)
+        return evaluate(info, level, detail, extra, warn=warn, crit=crit)
+    except NagaExit as exc:
+        return exc.code, exc.msg, exc.desc
+    except (IndexError, KeyError, ValueError, ZeroDivisionError) as exc:
+        return 3, 'could not parse %s output: %s' % (info, exc), None
+
+def submit_passive(command_file, results, now=None):
+    """ Write (host, service, status, message, perfdata) results to the
+    nagios external command file as passive service check results, all in
+    one write."""
+    if now is None:
+        now = time.time()
+    lines = []
+    for host, service, status, msg, perfdata in results:
+        output = NagaExit.format(status, msg, perfdata)
+        lines.append('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%s;%s\n' % (
+            now, host, service, status, output.replace('\n', '\\n')))
+    with open(command_file, 'a') as cmdfile:
+        cmdfile.write(''.join(lines))
+
+def submit_spool(spool_dir, results, now=None):
+    """ Write (host, service, status, message, perfdata) results into one
+    file in the nagios check result spool directory."""
+    if now is None:
+        now = time.time()
+    lines = ['### Active Check Result File ###', 'file_time=%d' % now, '']
+    for host, service, status, msg, perfdata in results:
+        output = NagaExit.format(status, msg, perfdata)
+        lines += [
+            '### Nagios Service Check Result ###',
+            '# Time: %s' % time.ctime(now),
+            'host_name=%s' % host,
+            'service_description=%s' % service,
+            'check_type=1',
+            'check_options=0',
+            'scheduled_check=0',
+            'reschedule_check=0',
+            'latency=0.0',
+            'start_time=%f' % now,
+            'finish_time=%f' % now,
+            'early_timeout=0',
+            'exited_ok=1',
+            'return_code=%s' % status,
+            'output=%s' % output.replace('\n', '\\n'),
+            '',
+            ]
+    fd, path = tempfile.mkstemp(prefix='c', dir=spool_dir)
+    try:
+        os.write(fd, '\n'.join(lines))
+    finally:
+        os.close(fd)
+    # nagios only reads result files once the matching .ok file exists
+    open(path + '.ok', 'w').close()
+    return path
+
+def finish_batch(results):
+    """ Exit with the worst status of the batch results, listing each."""
+    status = worst([result[1] for result in results])
+    counts = []
+    for code in (2, 1, 3):
+        found = [r[0] for r in results if r[1] == code]
+        if found:
+            counts.append('%s %s' % (NagaExit.prefix[code].lower(),
+                ', '.join(found)))
+    msg = '%s checks, %s' % (len(results), '; '.join(counts) or 'all ok')
+    perfdata = ' '.join([r[3] for r in results if r[3]])
+    # perfdata only goes in the | section of the first line
+    lines = [NagaExit.format(r[1], r[2]) for r in results]
+    raise NagaExit(status, msg, perfdata or None, lines)
+
+class Check(object):
+    """ A check from the scheduler inventory and the state of its run."""
+
+    def __init__(self, host, info, special=None, service=None, warn=None,
+            crit=None, interval=INTERVAL):
+        self.host = host
+        self.info = info
+        self.special = special
+        self.service = service or info
+        self.warn = warn
+        self.crit = crit
+        self.interval = interval
+        self.next_run = 0
+        self.started = None
+        self.proc = None
+        self.command = None
+        self.deadline = None
+        self.output = {}
+        self.open = set()
+        self.local = None
+
+    def start(self, timeout, binary, **kwargs):
+        """ Spawn the ssh command for this check without waiting for it."""
+        self.started = time.time()
+        breaker(self.host, **kwargs)
+        self.command = build_command(self.info, special=self.special)
+        self.deadline = deadline(self.host, self.command, timeout,
+                self.started, **kwargs)
+        if transport(self.host, **kwargs) == 'local':
+            self.start_local(binary, **kwargs)
+            return
+        command, script = remote_payload(self.command, **kwargs)
+        # new masters start in the background, plain ssh until they are up
+        cmd = transport_command(self.host, self.deadline, binary,
+                self.started, command, background_master=True, **kwargs)
+        logging.debug('scheduler starting %s', cmd)
+        self.proc = spawn(cmd, script)
+        self.output = {self.proc.stdout.fileno(): [],
+                self.proc.stderr.fileno(): []}
+        self.open = set(self.output)
+
+    def start_local(self, binary, **kwargs):
+        """ Run the check in process in a thread, which closes a pipe when
+        it is done so the scheduler polls it like an ssh check."""
+        done, finished = os.pipe()
+        # a list of its own for each run, a thread outliving a kill() does
+        # not touch the next run
+        self.local = outcome = []
+        def work():
+            try:
+                outcome.append(connect(self.host, self.info, self.deadline,
+                    binary, self.started, self.command, **kwargs))
+            except NagaExit as exc:
+                outcome.append(exc)
+            finally:
+                os.close(finished)
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        self.output = {done: []}
+        self.open = set(self.output)
+
+    def read(self, fd):
+        """ Read what is available on fd."""
+        data = os.read(fd, 65536)
+        if data:
+            self.output[fd].append(data)
+        else:
+            self.open.discard(fd)
+
+    def result(self, **kwargs):
+        """ Wait for the finished process and evaluate its output, return
+        a (host, service, status, message, perfdata) result."""
+        if self.local is not None:
+            outcome = self.local
+            self.close_local()
+            if isinstance(outcome[0], NagaExit):
+                return (self.host, self.service, outcome[0].code,
+                        outcome[0].msg, outcome[0].desc)
+            ret, out, err = outcome[0]
+        else:
+            ret = self.proc.wait()
+            out = ''.join(self.output[self.proc.stdout.fileno()])
+            err = ''.join(self.output[self.proc.stderr.fileno()])
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+            self.proc = None
+            record_health(self.host, ret != SSH_FAILURE, **kwargs)
+            if ret != SSH_FAILURE:
+                record_latency(self.host, self.command, self.started,
+                        **kwargs)
+        if ret != 0:
+            status = 3, 'ssh command returncode %s' % ret, None
+            logging.info('%s %s failed: %s', self.host, self.info, err)
+        else:
+            if self.special is not None:
+                kwargs['special'] = self.special
+            status = process(self.info, out, warn=self.warn, crit=self.crit,
+                    host=self.host, **kwargs)
+        return (self.host, self.service) + tuple(status)
+
+    def kill(self, **kwargs):
+        """ Terminate a check that ran out of time, return its result."""
+        record_health(self.host, False, **kwargs)
+        record_latency(self.host, self.command, self.started, **kwargs)
+        self.open = set()
+        if self.local is not None:
+            self.close_local()
+        else:
+            reap(self.proc)
+            self.proc = None
+        return (self.host, self.service, 3,
+                'timeout after waiting for ssh (%ss)' % self.deadline, None)
+
+    def close_local(self):
+        """ Close the pipe of a check run in process."""
+        for fd in self.output:
+            os.close(fd)
+        self.output = {}
+        self.local = None
+
+def read_inventory(path, interval=INTERVAL):
+    """ Read the scheduler inventory, one check per line in the form:
+    host info [special] [service=name] [warn=n] [crit=n] [interval=n]"""
+    checks = []
+    with open(path) as inventory:
+        for num, line in enumerate(inventory):
+            parts = line.split('#')[0].split()
+            if not parts:
+                continue
+            if len(parts) < 2 or parts[1] not in INFO_CHOICES:
+                raise NagaExit(3, 'invalid inventory line %s: %s' % (num+1,
+                    line.strip()))
+            opts = {'interval': interval}
+            for part in parts[2:]:
+                key, sep, val = part.partition('=')
+                try:
+                    if not sep:
+                        opts['special'] = part
+                    elif key == 'service':
+                        opts[key] = val
+                    elif key in ('warn', 'crit', 'interval'):
+                        opts[key] = float(val)
+                    else:
+                        raise ValueError(key)
+                except ValueError:
+                    raise NagaExit(3, 'invalid inventory line %s: %s' % (
+                        num+1, line.strip()))
+            checks.append(Check(parts[0], parts[1], **opts))
+    return checks
+
+def schedule(checks, timeout, binary, **kwargs):
+    """ Run the checks every interval (or only once each with once=True),
+    no more than max_concurrent at a time and max_per_host per host.
+    Results are submitted in bulk every flush_interval seconds."""
+    max_concurrent = int(kwargs.pop('max_concurrent', MAX_CONCURRENT))
+    max_per_host = int(kwargs.pop('max_per_host', MAX_PER_HOST))
+    jitter = float(kwargs.pop('jitter', JITTER))
+    flush_interval = float(kwargs.pop('flush_interval', FLUSH_INTERVAL))
+    once = kwargs.pop('once', False)
+    now = time.time()
+    for check in checks:
+        if not once:
+            # spread the first round over the interval
+            check.next_run = now + random.uniform(0, check.interval)
+    waiting = list(checks)
+    running = []
+    per_host = {}
+    results = []
+    last_flush = now
+    count = 0
+    while waiting or running:
+        poll_masters()
+        now = time.time()
+        waiting.sort(key=lambda check: check.next_run)
+        for check in list(waiting):
+            if check.next_run > now or len(running) >= max_concurrent:
+                break
+            if per_host.get(check.host, 0) >= max_per_host:
+                continue
+            waiting.remove(check)
+            try:
+                check.start(timeout, binary, **kwargs)
+            except NagaExit as exc:
+                results.append((check.host, check.service, exc.code,
+                    exc.msg, exc.desc))
+                count += 1
+                check.next_run = now + check.interval
+                if not once:
+                    waiting.append(check)
+                continue
+            running.append(check)
+            per_host[check.host] = per_host.get(check.host, 0) + 1
+
+        wait = flush_interval
+        if len(running) < max_concurrent:
+            # checks held back by max_per_host wait for a running check of
+            # their host instead, that is its fds or its deadline below
+            ready = [check.next_run - now for check in waiting
+                    if per_host.get(check.host, 0) < max_per_host]
+            wait = min([wait] + ready)
+        for check in running:
+            wait = min(wait, check.started + check.deadline - now)
+        fds = {}
+        for check in running:
+            for fd in check.open:
+                fds[fd] = check
+        for fd in select.select(list(fds), [], [], max(wait, 0))[0]:
+            fds[fd].read(fd)
+
+        now = time.time()
+        for check in list(running):
+            if not check.open:
+                results.append(check.result(**kwargs))
+            elif now - check.started > check.deadline:
+                results.append(check.kill(**kwargs))
+            else:
+                continue
+            count += 1
+            running.remove(check)
+            per_host[check.host] -= 1
+            check.next_run = check.started + check.interval * (
+                    1 + random.uniform(-jitter, jitter))
+            if not once:
+                waiting.append(check)
+
+        if results and (now - last_flush >= flush_interval or
+                not (waiting or running)):
+            submit(results, **kwargs)
+            results = []
+            last_flush = now
+    return count
+
+def submit(results, **kwargs):
+    """ Submit scheduler results to nagios in bulk."""
+    logging.debug('submitting %s results', len(results))
+    if 'exporter' in kwargs:
+        kwargs['exporter'].flush()
+    if kwargs.get('command_file'):
+        submit_passive(kwargs['command_file'], results)
+    if kwargs.get('checkresults_dir'):
+        submit_spool(kwargs['checkresults_dir'], results)
+    if not (kwargs.get('command_file') or kwargs.get('checkresults_dir')):
+        for result in results:
+            logging.info('%s %s %s', result[0], result[1],
+                    NagaExit.format(*result[2:]))
 
 def build_perfdata(data):
     if type(data) == list:
@@ -330,13 +2218,17 @@ def format_num(i, sigfig=2):
         else:
             return str(int(round(i, 0)))
 
-def main():
+def main(args=None):
     """ Called when running naga from command line."""
     start = time.time()
 
     required = ['information', 'hostname', 'binary', 'timeout', 'warning',
-            'critical']
-    opts = parse_opts()
+            'critical', 'batch', 'command_file', 'scheduler', 'interval',
+            'profile', 'server']
+    opts = parse_opts(args)
+    profile = None
+    if opts[0].profile:
+        profile = Profile(start)
     if opts[0].verbose:
         logging.basicConfig(level=logging.DEBUG)
     elif opts[0].capture:
@@ -358,11 +2250,85 @@ def main():
         if key not in required and val is not None:
             kwargs[key] = val
 
+    if kwargs.get('transport') == 'replay' and [name for name in ('batch',
+            'counters', 'scheduler') if getattr(opts[0], name)]:
+        # the captures only answer the plain command of a single check
+        raise NagaExit(3, 'the replay transport does not support --batch, '
+                '--counters or --scheduler')
+
+    if opts[0].export:
+        kwargs['exporter'] = Exporter(kwargs.pop('export'))
+
+    if opts[0].server:
+        serve(opts[0].server)
+        raise NagaExit(0, 'server on %s stopped' % opts[0].server)
+
+    if opts[0].scheduler:
+        checks = read_inventory(opts[0].scheduler, float(opts[0].interval))
+        count = schedule(checks, tout, opts[0].binary,
+                command_file=opts[0].command_file, **kwargs)
+        raise NagaExit(0, 'scheduler ran %s checks' % count)
+
+    if profile is not None:
+        kwargs['profile'] = profile
+    try:
+        if opts[0].batch:
+            results = run_batch(opts[0].hostname, parse_batch(opts[0].batch),
+                    tout, opts[0].binary, start, warn=warn, crit=crit,
+                    **kwargs)
+            if opts[0].command_file:
+                submit_passive(opts[0].command_file,
+                        [(opts[0].hostname,) + r for r in results])
+            finish_batch(results)
+        hosts = cluster_hosts(opts[0].hostname)
+        if hosts is not None:
+            check_cluster(hosts, info, tout, opts[0].binary, start, warn,
+                    crit, **kwargs)
+        check(opts[0].hostname, info, tout, opts[0].binary, start, warn, crit,
+                **kwargs)
+    except NagaExit as exc:
+        if profile is not None:
+            profile.report(exc, opts[0].hostname, opts[0].batch or info)
+        raise
+    finally:
+        if 'exporter' in kwargs:
+            kwargs['exporter'].flush()
+
+def check(hostname, info, tout, binary, start, warn=None, crit=None,
+        **kwargs):
+    """ Run the check for info against hostname and exit with its status."""
+    level, detail, extra = measure(hostname, info, tout, binary, start,
+            **kwargs)
+    status = evaluate(info, level, detail, extra, warn=warn, crit=crit)
+    profile = kwargs.get('profile')
+    if profile is not None:
+        profile.mark('evaluate')
+    raise NagaExit(*status)
+
+def measure(hostname, info, tout, binary, start, **kwargs):
+    """ Fetch and parse info from hostname, return its level, detail and
+    extra."""
     if not info in globals().keys():
         raise NagaExit(3, 'Could not find processing method for %s' % info)
-    logging.debug('about to connect to %s', opts[0].hostname)
-    out = connect(opts[0].hostname, info, tout, opts[0].binary, 
-            start, **kwargs)
+    stream = globals().get('%s_stream' % info)
+    if stream is not None:
+        kwargs['done'] = stream(**kwargs)
+    profile = kwargs.get('profile')
+    command = None
+    if float(kwargs.get('probe_ttl') or 0) > 0:
+        command = variant(hostname, info, *probe(hostname, tout, binary,
+            start, **kwargs))
+    logging.debug('about to connect to %s', hostname)
+    if command is not None:
+        out = fetch(hostname, info, tout, binary, start, command=command,
+                **kwargs)
+    elif kwargs.get('counters') and info in COUNTER_CHOICES:
+        out, kwargs['elapsed'] = counters(hostname, info, tout, binary,
+                start, **kwargs)
+    else:
+        out = fetch(hostname, info, tout, binary, start, **kwargs)
+    if profile is not None:
+        profile.mark('fetch')
     logging.debug('return of ssh command: %s', out[0])
     logging.debug('stdout of ssh command: %s', out[1])
     logging.debug('stderr of ssh command: %s', out[2])
@@ -374,9 +2340,286 @@ def main():
     if 'capture' in kwargs:
         capture_output(out, kwargs['capture'])
 
-    level, detail, extra = globals()[info](out[1], **kwargs)
+    result = globals()[info](out[1], **kwargs)
+    if 'exporter' in kwargs:
+        kwargs['exporter'].add(hostname, info, result[1])
+    if profile is not None:
+        profile.mark('parse')
     timecheck(start, tout, 'after running %s()' % info)
-    finish(info, level, detail, extra, warn=warn, crit=crit)
+    return result
+
+def probe(hostname, tout, binary, start, **kwargs):
+    """ Return the OS of hostname (as uname -s) and the set of the files
+    and commands of INFO_NEEDS and INFO_VARIANTS it has. The host is only
+    probed again after probe_ttl seconds, concurrent checks wait for the
+    one probing."""
+    path = state_file(kwargs.get('state_dir', STATE_DIR), 'probe', hostname)
+    ttl = float(kwargs.get('probe_ttl', PROBE_TTL))
+    with open(path + '.lock', 'w') as lock:
+        wait_lock(lock, start, tout, 'probe')
+        data = read_state(path)
+        if data is None or os.path.getmtime(path) < time.time() - ttl:
+            ret, data, err = connect(hostname, 'probe', tout, binary, start,
+                    command=probe_command(), **kwargs)
+            if ret != 0 or not data.strip():
+                raise NagaExit(3, 'could not probe %s: returncode %s' % (
+                    hostname, ret), 'out=%s;err=%s ' % (data, err))
+            write_state(path, data)
+    lines = data.split('\n')
+    return lines[0].strip(), set([line.strip() for line in lines[1:]])
+
+def probe_command():
+    """ Command printing the OS and which of the probed paths exist."""
+    paths = set()
+    for info, needs in INFO_NEEDS.items():
+        paths.update(needs)
+        for variant_needs, command in INFO_VARIANTS.get(info, []):
+            paths.update(variant_needs)
+    return ['uname', '-s', '&&', 'ls', '-d'] + sorted(paths) + [
+            '||', 'true']
+
+def variant(hostname, info, system, found):
+    """ Command for info on a host with the found paths: None when the
+    usual command works there, else the first variant that does."""
+    if not [need for need in INFO_NEEDS.get(info, []) if need not in found]:
+        return None
+    for needs, command in INFO_VARIANTS.get(info, []):
+        if not [need for need in needs if need not in found]:
+            return command
+    raise NagaExit(3, '%s is not available on %s (%s)' % (info, hostname,
+        system))
+
+def cluster_hosts(hostname):
+    """ Return the hosts of a cluster given as a comma separated list or as
+    @file, a file with one host per line (# starts a comment). Return None
+    if hostname is a single host."""
+    if hostname.startswith('@'):
+        try:
+            with open(hostname[1:]) as hostfile:
+                return [line.split('#')[0].strip() for line in hostfile
+                        if line.split('#')[0].strip()]
+        except IOError as exc:
+            raise NagaExit(3, 'could not read host list %s: %s' % (
+                hostname[1:], exc.strerror))
+    if ',' in hostname:
+        return [host.strip() for host in hostname.split(',') if host.strip()]
+    return None
+
+def check_cluster(hosts, info, tout, binary, start, warn=None, crit=None,
+        **kwargs):
+    """ Run the check for info on all hosts in parallel, at most
+    max_concurrent at a time, and exit with the status of their levels
+    reduced by the aggregate option. Hosts that could not be checked are
+    left out of the aggregate and listed."""
+    kwargs.pop('profile', None)
+    how = kwargs.get('aggregate') or AGGREGATE_DEFAULT
+    pending = list(hosts)
+    results = {}
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                host = pending.pop(0)
+            try:
+                results[host] = measure(host, info, tout, binary, start,
+                        **kwargs)
+            except NagaExit as exc:
+                results[host] = exc
+            except Exception as exc:
+                results[host] = NagaExit(3, 'could not parse %s output: %s'
+                        % (info, exc))
+    limit = int(kwargs.get('max_concurrent', MAX_CONCURRENT))
+    threads = [threading.Thread(target=work) for i in range(min(limit,
+        len(hosts)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    levels = []
+    perfdata = []
+    failed = []
+    for host in hosts:
+        if isinstance(results[host], NagaExit):
+            logging.info('%s: %s', host, results[host].msg)
+            failed.append(host)
+            continue
+        level, detail, extra = results[host]
+        levels.append((level, host))
+        perfdata.append(host_perfdata(host, detail))
+    if not levels:
+        raise NagaExit(3, 'could not check any of %s hosts (%s)' % (
+            len(hosts), ', '.join(failed)))
+    try:
+        level, extra, opts = aggregate(info, levels, how)
+    except ValueError:
+        raise NagaExit(3, 'invalid aggregate %s' % how)
+    if failed:
+        extra += ', unknown: %s' % ', '.join(failed)
+    status, msg, agg_perfdata = evaluate(info, level, [(how.split(':')[0],
+        level)], extra, warn=warn, crit=crit, **opts)
+    raise NagaExit(status, msg, ' '.join([agg_perfdata] + perfdata))
+
+def aggregate(info, levels, how):
+    """ Reduce the (level, host) levels of a cluster with how, return the
+    level, a description of it and the options evaluate() needs for it.
+    Raise ValueError for an unknown how."""
+    levels = sorted(levels)
+    count = len(levels)
+    if how == 'max':
+        return levels[-1][0], 'on %s of %s hosts' % (levels[-1][1], count), {}
+    if how == 'min':
+        return levels[0][0], 'on %s of %s hosts' % (levels[0][1], count), {}
+    if how == 'mean':
+        return (sum([level for level, host in levels]) / count,
+                'mean of %s hosts' % count, {})
+    if how[:1] == 'p':
+        return (percentile(levels, float(how[1:]))[0],
+                '%s of %s hosts' % (how, count), {})
+    if how.split(':')[0] == 'count':
+        if ':' in how:
+            threshold = float(how.split(':')[1])
+        else:
+            threshold = INFO_LEVELS[info][0]
+        over = [host for level, host in levels if level >= threshold]
+        if INFO_UNITS[info] == '%':
+            shown = format_num(threshold * 100) + '%'
+        else:
+            shown = format_num(threshold) + INFO_UNITS[info]
+        extra = 'of %s hosts at or over %s' % (count, shown)
+        if over:
+            extra += ' (%s)' % ', '.join(over)
+        # by default warn for one host over the level, critical for half
+        return len(over), extra, {'unit': '', 'levels': [1, max(2,
+            (count + 1) / 2)]}
+    raise ValueError(how)
+
+def percentile(values, pct):
+    """ The pct-th percentile (nearest rank) of the sorted values."""
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def host_perfdata(host, detail):
+    """ Perfdata of detail with every label prefixed with host."""
+    items = []
+    for item in detail:
+        label = str(item[0])
+        if label.startswith("'"):
+            label = "'%s_%s" % (host, label[1:])
+        else:
+            label = '%s_%s' % (host, label)
+        items.append((label,) + tuple(item[1:]))
+    return build_perfdata(items)
+
+def serve(path):
+    """ Answer check requests from naga/client.py on the unix socket at
+    path. Every request is run in a forked child of this process, which
+    saves starting and importing a new interpreter for each check."""
+    import getpass # imported for every check, have it loaded already
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(path):
+        if socket_alive(path):
+            raise NagaExit(3, 'a server is already listening on %s' % path)
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(128)
+    server.settimeout(1)
+    logging.info('naga server listening on %s', path)
+    signal.signal(signal.SIGTERM, stop_server)
+    try:
+        while True:
+            reap_children()
+            try:
+                conn = server.accept()[0]
+            except socket.timeout:
+                continue
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                try:
+                    handle_request(conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
+
+def stop_server(signum, frame):
+    """ Stop the server on SIGTERM, like on a keyboard interrupt."""
+    raise KeyboardInterrupt()
+
+def reap_children():
+    """ Collect the exit status of finished request handlers."""
+    while True:
+        try:
+            pid = os.waitpid(-1, os.WNOHANG)[0]
+        except OSError:
+            return
+        if pid == 0:
+            return
+
+def handle_request(conn):
+    """ Run the command line sent by the client on conn (every argument
+    terminated by a NUL) and reply with the exit code on the first line,
+    then stdout, a NUL and stderr."""
+    conn.settimeout(None)
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    if not chunks:
+        # a connect without a request, like socket_alive() checking whether
+        # the server is up, is not a check with the default options
+        conn.close()
+        return
+    args = ''.join(chunks).split('\0')[:-1]
+    code, out, err = run(args)
+    conn.sendall('%s\n%s\0%s' % (code, out, err))
+    conn.close()
+
+def run(args):
+    """ Run naga with the command line args as if it was started from a
+    shell, return its exit code, stdout and stderr."""
+    import StringIO
+    import traceback
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    # let main() set up logging for this command line (to the new stderr)
+    logging.root.handlers = []
+    try:
+        try:
+            main(args)
+            code = 0
+        except NagaExit as exc:
+            print exc.collate_output()
+            code = exc.code
+        except SystemExit as exc:
+            if exc.code is None or isinstance(exc.code, int):
+                code = exc.code or 0
+            else:
+                print >> sys.stderr, exc.code
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        return code, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
 
 def capture_output(out, location):
     """Capture the output out (usually of ssh command) and print to file."""
@@ -385,24 +2628,251 @@ def capture_output(out, location):
         capt.write(out[1])
 
 
+def monotonic():
+    """ Seconds on a monotonic clock. Python 2 has none, so the first call
+    looks one up: clock_gettime() through ctypes, or failing that the
+    elapsed real time of os.times() (which has clock tick resolution)."""
+    global monotonic
+    if hasattr(time, 'monotonic'):
+        monotonic = time.monotonic
+        return monotonic()
+    try:
+        import ctypes
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        clock_gettime = ctypes.CDLL(None).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        spec = Timespec()
+        def monotonic_ctypes():
+            clock_gettime(1, ctypes.byref(spec)) # CLOCK_MONOTONIC
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        monotonic_ctypes()
+        monotonic = monotonic_ctypes
+    except (ImportError, AttributeError, OSError):
+        monotonic = lambda: os.times()[4]
+    return monotonic()
+
+def process_age():
+    """ Seconds since this process started, None without /proc."""
+    try:
+        with open('/proc/self/stat') as proc_stat:
+            fields = proc_stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as proc_uptime:
+            uptime = float(proc_uptime.read().split()[0])
+        return uptime - float(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (IOError, IndexError, ValueError, OSError):
+        return None
+
+class Profile(object):
+    """Monotonic timings of the phases of a check, see --profile."""
+
+    def __init__(self, start):
+        self.phases = []
+        self.times = {}
+        startup = process_age()
+        if startup is not None:
+            # checks run by a server start in a fork, close to no time
+            self.add('startup', max(startup - (time.time() - start), 0))
+        # naga started at start, before there was a monotonic clock
+        self.add('options', time.time() - start)
+        self.last = monotonic()
+
+    def add(self, phase, seconds):
+        """Account seconds to phase."""
+        if phase not in self.times:
+            self.phases.append(phase)
+            self.times[phase] = 0.0
+        self.times[phase] += seconds
+
+    def mark(self, phase):
+        """Account the time since the previous mark to phase."""
+        now = monotonic()
+        self.add(phase, max(now - self.last, 0))
+        self.last = now
+
+    def perfdata(self):
+        """Timings as naga_<phase>_ms perfdata."""
+        items = ['naga_%s_ms=%s' % (phase, format_num(self.times[phase]*1000))
+                for phase in self.phases]
+        items.append('naga_total_ms=%s' % format_num(
+            sum(self.times.values())*1000))
+        return ' '.join(items)
+
+    def report(self, exc, hostname, info):
+        """Add the timings to the perfdata of exc and log them."""
+        perfdata = self.perfdata()
+        logging.debug('profile host=%s info=%s status=%s %s', hostname, info,
+                exc.code, perfdata.replace('naga_', ''))
+        if exc.desc:
+            exc.desc = '%s %s' % (exc.desc, perfdata)
+        else:
+            exc.desc = perfdata
+
+class Exporter(object):
+    """Parsed values in line protocol, buffered until flush() writes them
+    to a file, named pipe or unix socket, see --export."""
+
+    def __init__(self, path, max_lines=EXPORT_MAX_LINES):
+        self.path = path
+        self.max_lines = max_lines
+        self.lines = []
+        self.dropped = 0
+        self.out = None
+        # the first line is the rest of one partly sent on self.out
+        self.partial = False
+        self.lock = threading.Lock()
+
+    def add(self, host, info, detail, now=None):
+        """Buffer the values of detail that are numbers, one line each:
+        naga,host=H,info=I,target=LABEL value=V TIMESTAMP
+        Detail that is not a list of (label, value, ...) items is skipped."""
+        if now is None:
+            now = time.time()
+        if not isinstance(detail, (list, tuple)):
+            return
+        prefix = 'naga,host=%s,info=%s,target=' % (self.escape(host), info)
+        suffix = ' %d\n' % (now * 10**9)
+        lines = []
+        for item in detail:
+            if not isinstance(item, (list, tuple)) or len(item) < 2:
+                continue
+            try:
+                value = float(item[1])
+            except (TypeError, ValueError):
+                continue
+            if math.isinf(value) or math.isnan(value):
+                continue
+            # quoted perfdata labels (filesystems) are exported unquoted
+            lines.append(prefix + self.escape(str(item[0]).strip("'")) +
+                    ' value=' + repr(value) + suffix)
+        with self.lock:
+            self.lines += lines
+            overflow = len(self.lines) - self.max_lines
+            if overflow > 0:
+                first = int(self.partial)
+                del self.lines[first:first + overflow]
+                self.dropped += overflow
+
+    @staticmethod
+    def escape(value):
+        """Escape a tag value of line protocol."""
+        return str(value).replace('\\', '\\\\').replace(',', '\\,').replace(
+                ' ', '\\ ').replace('=', '\\=')
+
+    def flush(self):
+        """Write as much of the buffer as the destination takes without
+        blocking, in chunks of whole lines. The rest is kept for the next
+        flush, so a busy or absent reader never holds up a check."""
+        with self.lock:
+            while self.lines:
+                size = 0
+                count = 0
+                for line in self.lines:
+                    if count and size + len(line) > EXPORT_CHUNK:
+                        break
+                    size += len(line)
+                    count += 1
+                chunk = ''.join(self.lines[:count])
+                try:
+                    sent = self.write(chunk)
+                except (OSError, IOError, socket.error) as exc:
+                    if exc.errno not in (errno.EAGAIN, errno.ENXIO):
+                        logging.info('could not export to %s: %s', self.path,
+                                exc)
+                    self.close()
+                    break
+                del self.lines[:count]
+                self.partial = False
+                if sent < len(chunk):
+                    self.lines.insert(0, chunk[sent:])
+                    self.partial = True
+                    break
+        if self.dropped:
+            logging.info('dropped %s lines for %s', self.dropped, self.path)
+            self.dropped = 0
+
+    def write(self, chunk):
+        """Write chunk without blocking, return the bytes written."""
+        if self.out is None:
+            try:
+                mode = os.stat(self.path).st_mode
+            except OSError:
+                mode = 0
+            if stat.S_ISSOCK(mode):
+                self.out = self.connect()
+            else:
+                self.out = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                        os.O_CREAT | os.O_NONBLOCK, 0644)
+        if isinstance(self.out, socket.socket):
+            return self.out.send(chunk)
+        return os.write(self.out, chunk)
+
+    def connect(self):
+        """Non-blocking connection to the unix socket at path, a datagram
+        one if it takes datagrams (every chunk is sent whole)."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as exc:
+            sock.close()
+            if exc.errno != errno.EPROTOTYPE:
+                raise
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                sock.close()
+                raise
+        sock.setblocking(0)
+        return sock
+
+    def close(self):
+        """Close the destination, it is opened again by the next flush. The
+        rest of a partly sent line is dropped, a new connection could not
+        make sense of it."""
+        if self.out is None:
+            return
+        if isinstance(self.out, socket.socket):
+            self.out.close()
+        else:
+            os.close(self.out)
+        self.out = None
+        if self.partial:
+            del self.lines[0]
+            self.partial = False
+            self.dropped += 1
+
 class NagaExit(SystemExit):
     """Raised when we want to exit from naga."""
 
     prefix = {0: 'OK', 1: 'Warning', 2: 'Critical', 3: 'Unknown'}
     
-    def __init__(self, status, msg, desc=None):
+    def __init__(self, status, msg, desc=None, lines=None):
         self.code = status
         self.msg = msg
         self.desc = desc
-        print self.collate_output()
+        self.lines = lines
         super(NagaExit, self).__init__()
 
     def collate_output(self):
         """Produce output conforming to nagios plugin guidelines."""
-        out = [self.prefix[self.code]+':', self.msg]
-        if self.desc is not None:
-            out.extend(['|', self.desc])
+        out = self.format(self.code, self.msg, self.desc)
+        if self.lines:
+            out = '\n'.join([out] + self.lines)
+        return out
+
+    @classmethod
+    def format(cls, status, msg, desc=None):
+        """Format a single status line."""
+        out = [cls.prefix[status]+':', msg]
+        if desc is not None:
+            out.extend(['|', desc])
         return ' '.join(out)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except NagaExit as exc:
+        print exc.collate_output()
+        raise
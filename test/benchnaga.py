@@ -0,0 +1,281 @@
+""" benchnaga.py
+Throughput benchmarks for the naga parsers using synthetic output of large
+hosts (many cores, mounts and interfaces). Run from the project directory:
+
+    python -m test.benchnaga --save bench.json
+    python -m test.benchnaga --compare bench.json
+
+Each benchmark is run in a forked child so its peak memory can be measured
+on its own. --compare exits with status 1 if any benchmark got slower (or
+bigger) than the baseline by more than --tolerance.
+"""
+
+import json
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+
+from naga import naga
+
+SCALES = {
+ 'cores': [4, 64, 256, 512],
+ 'mounts': [10, 1000, 5000],
+ 'ifaces': [10, 1000, 5000],
+ 'disks': [8, 256, 4096],
+ }
+
+def proc_stat(cores, seed=0):
+    """ Two reads of /proc/stat for a host with cores cpus, as returned by
+    the cpu command (including the long intr and softirq lines)."""
+    rand = random.Random(seed)
+    counters = [[rand.randint(1000, 10**7) for i in range(10)]
+            for cpu in range(cores)]
+    out = []
+    for snapshot in range(2):
+        lines = []
+        for cpu in counters:
+            for i in range(len(cpu)):
+                cpu[i] += rand.randint(0, 100)
+        total = [sum(col) for col in zip(*counters)]
+        lines.append('cpu  ' + ' '.join([str(i) for i in total]))
+        for n, cpu in enumerate(counters):
+            lines.append('cpu%s %s' % (n, ' '.join([str(i) for i in cpu])))
+        lines.append('intr %s' % ' '.join([str(rand.randint(0, 10**6))
+            for i in range(cores * 8)]))
+        lines += ['ctxt 2286318', 'btime 1376444467', 'processes 25372',
+                'procs_running 1', 'procs_blocked 0']
+        lines.append('softirq %s' % ' '.join([str(rand.randint(0, 10**6))
+            for i in range(11)]))
+        out += lines
+    return '\n'.join(out) + '\n'
+
+def df_p(mounts, seed=0):
+    """ Output of df -P with mounts filesystems."""
+    rand = random.Random(seed)
+    lines = ['Filesystem            1K-blocks       Used  Available Use% '
+            'Mounted on', '/dev/sda1 115065400 23939856 85273896 22% /']
+    for i in range(mounts - 1):
+        blocks = rand.randint(10**5, 10**9)
+        used = rand.randint(0, blocks)
+        device = rand.choice(['/dev/sd%s%s' % (chr(97 + i % 26), i % 9),
+            'tmpfs', 'overlay'])
+        lines.append('%s %s %s %s %s%% /data/%s' % (device, blocks, used,
+            blocks - used, used * 100 / blocks, i))
+    return '\n'.join(lines) + '\n'
+
+def free_m(scale=1):
+    """ Output of free -m on a host with scale times 8GB of memory."""
+    total = 7960 * scale
+    return ('             total       used       free     shared    buffers'
+            '     cached\n'
+            'Mem:       %8s   %8s   %8s          0   %8s   %8s\n'
+            '-/+ buffers/cache:   %8s   %8s\n'
+            'Swap:            0          0          0\n') % (total,
+                    total * 7 / 8, total / 8, total / 16, total / 3,
+                    total / 2, total / 2)
+
+def proc_meminfo(scale=1):
+    """ /proc/meminfo of a host with scale times 8GB of memory."""
+    total = 8151040 * scale
+    fields = [('MemTotal', total), ('MemFree', total / 8), ('MemAvailable',
+        total / 2), ('Buffers', total / 16), ('Cached', total / 3),
+        ('SwapCached', 0), ('Active', total / 2), ('Inactive', total / 4)]
+    fields += [(name, scale * 1024) for name in ('Active(anon)',
+        'Inactive(anon)', 'Active(file)', 'Inactive(file)', 'Unevictable',
+        'Mlocked')]
+    fields += [('SwapTotal', total / 4), ('SwapFree', total / 8),
+        ('Dirty', 2048), ('Writeback', 0), ('AnonPages', total / 3),
+        ('Mapped', total / 20), ('Shmem', total / 50), ('Slab', total / 40),
+        ('SReclaimable', total / 60), ('SUnreclaim', total / 120)]
+    fields += [(name, scale * 512) for name in ('KernelStack', 'PageTables',
+        'NFS_Unstable', 'Bounce', 'WritebackTmp')]
+    fields += [('CommitLimit', total), ('Committed_AS', total / 2),
+        ('VmallocTotal', 34359738367), ('VmallocUsed', 65536),
+        ('VmallocChunk', 0), ('AnonHugePages', total / 10)]
+    lines = ['%-16s%10s kB' % (name + ':', value) for name, value in fields]
+    lines += ['HugePages_Total:     512', 'HugePages_Free:      128',
+            'HugePages_Rsvd:        0', 'HugePages_Surp:        0',
+            'Hugepagesize:       2048 kB']
+    return '\n'.join(lines) + '\n'
+
+def vmstat(scale=1):
+    """ Output of vmstat 10 2."""
+    return ('procs -----------memory---------- ---swap-- -----io---- -system-- '
+            '----cpu----\n'
+            ' r  b   swpd   free   buff  cache   si   so    bi    bo   in   cs '
+            'us sy id wa\n'
+            ' 1  0      0 1019852 470152 2688204    0    0     9    20   12    '
+            '3  7  2 90  0\n'
+            ' 7  0      0 650644 470188 3006288    0    0  %s %s 1201 3295 38 '
+            '12 46  4\n') % (1318 * scale, 13157 * scale)
+
+def diskstats(disks, seed=0):
+    """ Output of the disk command for a host with disks disks of two
+    partitions each."""
+    rand = random.Random(seed)
+    names = []
+    for i in range(disks):
+        name = 'sd%s%s' % (chr(97 + i % 26), chr(97 + i / 26 % 26) * (i / 26))
+        names += [name, name + '1', name + '2']
+    counters = [[rand.randint(0, 10**9) for i in range(11)] for name in names]
+    samples = []
+    for snapshot in range(2):
+        lines = ['%s.47 1378213.61' % (350735 + snapshot * 2)]
+        for n, (name, row) in enumerate(zip(names, counters)):
+            lines.append('8 %s %s %s' % (n, name, ' '.join([str(i)
+                for i in row])))
+            for i in range(len(row)):
+                row[i] += rand.randint(0, 1000)
+        samples.append('\n'.join(lines))
+    return ('\n%s\n' % naga.DIVIDE).join(samples) + '\n'
+
+def proc_net_dev(ifaces, seed=0):
+    """ Output of the network command for a host with ifaces interfaces,
+    most of them container veths."""
+    rand = random.Random(seed)
+    names = ['eth0', 'lo'] + ['veth%x' % rand.getrandbits(28)
+            for i in range(ifaces - 2)]
+    counters = [[rand.randint(0, 2**40) for i in range(16)] for name in names]
+    samples = []
+    for snapshot in range(2):
+        lines = ['%s.47 1378213.61' % (350735 + snapshot * 10),
+            'Inter-|   Receive                                                '
+            '|  Transmit',
+            ' face |bytes    packets errs drop fifo frame compressed multicast'
+            '|bytes    packets errs drop fifo colls carrier compressed']
+        for name, row in zip(names, counters):
+            lines.append('%6s: %s' % (name, ' '.join([str(i) for i in row])))
+            for i in range(len(row)):
+                row[i] += rand.randint(0, 10**6)
+        samples.append('\n'.join(lines))
+    return ('\n%s\n' % naga.DIVIDE).join(samples) + '\n'
+
+def benchmarks():
+    """ Return a list of (name, function) benchmarks at every scale."""
+    benches = []
+    for cores in SCALES['cores']:
+        out = proc_stat(cores)
+        benches.append(('cpu/%s' % cores, lambda out=out: naga.cpu(out)))
+        benches.append(('cpu_core/%s' % cores, lambda out=out,
+            special='cpu%s' % (cores - 1): naga.cpu(out, special=special)))
+        benches.append(('cpu_hottest/%s' % cores, lambda out=out:
+            naga.cpu(out, special='hottest')))
+    for mounts in SCALES['mounts']:
+        out = df_p(mounts)
+        benches.append(('filesystem/%s' % mounts,
+            lambda out=out: naga.filesystem(out)))
+        benches.append(('filesystem_glob/%s' % mounts,
+            lambda out=out: naga.filesystem(out, special='/data/1*')))
+    for ifaces in SCALES['ifaces']:
+        out = proc_net_dev(ifaces)
+        benches.append(('network/%s' % ifaces,
+            lambda out=out: naga.network(out)))
+        benches.append(('network_exclude/%s' % ifaces,
+            lambda out=out: naga.network(out, special='!veth*')))
+        detail = naga.network(out)[1]
+        benches.append(('build_perfdata/%s' % (ifaces * 8),
+            lambda detail=detail: naga.build_perfdata(detail)))
+    for disks in SCALES['disks']:
+        out = diskstats(disks)
+        benches.append(('disk/%s' % disks, lambda out=out: naga.disk(out)))
+    out = free_m()
+    benches.append(('memory', lambda: naga.memory(out)))
+    benches.append(('memory_meminfo', lambda out=proc_meminfo():
+        naga.memory(out)))
+    benches.append(('disk_vmstat', lambda out=vmstat(): naga.disk(out)))
+    nums = [random.Random(0).uniform(0, 10**4) for i in range(1000)]
+    benches.append(('format_num/1000',
+        lambda: [naga.format_num(i) for i in nums]))
+    return benches
+
+def measure(func, min_time=0.2):
+    """ Best time per call of func (seconds) and peak memory (kB) of a
+    child process running it."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            best = None
+            calls = 1
+            spent = 0
+            while spent < min_time:
+                start = time.time()
+                for i in xrange(calls):
+                    func()
+                elapsed = time.time() - start
+                spent += elapsed
+                per_call = elapsed / calls
+                if best is None or per_call < best:
+                    best = per_call
+                calls *= 2
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+            os.write(write_end, json.dumps([best, peak]))
+        except BaseException as exc:
+            os.write(write_end, json.dumps({'error': repr(exc)}))
+        os._exit(0)
+    os.close(write_end)
+    data = ''
+    while True:
+        chunk = os.read(read_end, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    result = json.loads(data)
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+def compare(results, baseline, tolerance):
+    """ Return the lines describing results worse than baseline."""
+    regressions = []
+    for name, (seconds, peak) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base_seconds, base_peak = baseline[name]
+        if seconds > base_seconds * tolerance:
+            regressions.append('%s: %.1fus per call, baseline %.1fus' % (
+                name, seconds * 10**6, base_seconds * 10**6))
+        # peak rss is only accurate to a page or so, ignore small changes
+        if peak > base_peak * tolerance and peak - base_peak > 1024:
+            regressions.append('%s: %skB peak, baseline %skB' % (name, peak,
+                base_peak))
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(description='Benchmark the naga parsers.')
+    parser.add_option('--save', help='Save the results as a baseline file.')
+    parser.add_option('--compare', help='Compare with a baseline file.')
+    parser.add_option('--tolerance', default='1.5',
+        help='Slowdown factor counted as a regression (default 1.5).')
+    parser.add_option('--filter', default='',
+        help='Only run benchmarks whose name starts with this.')
+    opts = parser.parse_args()[0]
+
+    results = {}
+    for name, func in benchmarks():
+        if not name.startswith(opts.filter):
+            continue
+        seconds, peak = measure(func)
+        results[name] = [seconds, peak]
+        print '%-24s %12.1fus %8skB' % (name, seconds * 10**6, peak)
+    if opts.save:
+        with open(opts.save, 'w') as baseline:
+            json.dump(results, baseline, indent=1, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as baseline:
+            regressions = compare(results, json.load(baseline),
+                    float(opts.tolerance))
+        for line in regressions:
+            print 'REGRESSION', line
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
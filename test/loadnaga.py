@@ -0,0 +1,138 @@
+""" loadnaga.py
+Load test naga end to end without a network: thousands of simulated checks
+run through main(), the replay transport (captured outputs, by default those
+in test/static) and the parsers. Run from the project directory:
+
+    python -m test.loadnaga --checks 5000 --workers 16 --latency 0.05
+
+Each worker is a forked process running its share of the checks one after
+the other, like a nagios worker. With --exec every check starts a new
+python running naga.py, as nagios does, otherwise checks run in the worker
+itself (as with the resident server). Throughput, latency percentiles, exit
+statuses and the peak memory of a worker are reported.
+"""
+
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from naga import naga
+
+def check_args(num, hosts, infos, opts):
+    """ Command line of the num-th simulated check."""
+    args = ['-H', 'host%s' % (num % hosts), '-i', infos[num % len(infos)],
+            '-t', opts.timeout, '--transport', 'replay',
+            '--replay-dir', opts.replay_dir,
+            '--replay-latency', opts.latency,
+            '--replay-jitter', opts.jitter,
+            '--replay-failures', opts.failures]
+    return args + opts.args
+
+def run_check(args, exec_naga):
+    """ Run one check, return its exit code."""
+    if exec_naga:
+        devnull = open(os.devnull, 'w')
+        try:
+            return subprocess.call([sys.executable, 'naga/naga.py'] + args,
+                    stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+    return naga.run(args)[0]
+
+def worker(checks, exec_naga, write_end):
+    """ Run the checks, write their latencies and codes to write_end."""
+    results = []
+    for args in checks:
+        start = time.time()
+        code = run_check(args, exec_naga)
+        results.append([time.time() - start, code])
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if exec_naga:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    data = json.dumps({'results': results, 'maxrss': usage})
+    while data:
+        data = data[os.write(write_end, data):]
+
+def load(checks, workers, exec_naga):
+    """ Run the checks spread over workers, return the latencies and exit
+    codes of all checks, the wall time taken and the peak rss (kB)."""
+    pipes = []
+    for num in range(workers):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            try:
+                worker(checks[num::workers], exec_naga, write_end)
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        pipes.append((pid, read_end))
+    start = time.time()
+    results = []
+    maxrss = 0
+    for pid, read_end in pipes:
+        data = ''
+        while True:
+            chunk = os.read(read_end, 65536)
+            if not chunk:
+                break
+            data += chunk
+        os.close(read_end)
+        os.waitpid(pid, 0)
+        if not data:
+            raise RuntimeError('worker %s died' % pid)
+        report = json.loads(data)
+        results += report['results']
+        maxrss = max(maxrss, report['maxrss'])
+    return results, time.time() - start, maxrss
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [-- naga options]',
+            description='Load test naga with replayed checks.')
+    parser.add_option('--checks', default='1000',
+        help='Number of checks to run (default 1000).')
+    parser.add_option('--hosts', default='100',
+        help='Number of simulated hosts (default 100).')
+    parser.add_option('--infos', default='load,memory,cpu,disk,filesystem,'
+        'network', help='Comma separated info types to check.')
+    parser.add_option('--workers', default='8',
+        help='Number of checks run at the same time (default 8).')
+    parser.add_option('--exec', dest='exec_naga', action='store_true',
+        help='Start a new naga.py for every check.')
+    parser.add_option('--replay-dir', default=naga.REPLAY_DIR,
+        help='Directory of the captured outputs (default %s).' %
+        naga.REPLAY_DIR)
+    parser.add_option('--latency', default='0',
+        help='Simulated seconds the hosts take to answer.')
+    parser.add_option('--jitter', default='0',
+        help='Seconds the latency randomly varies by.')
+    parser.add_option('--failures', default='0',
+        help='Fraction of checks that fail to connect.')
+    parser.add_option('--timeout', default='30',
+        help='Timeout of each check.')
+    opts, args = parser.parse_args()
+    opts.args = args
+
+    infos = opts.infos.split(',')
+    checks = [check_args(num, int(opts.hosts), infos, opts)
+            for num in range(int(opts.checks))]
+    results, wall, maxrss = load(checks, int(opts.workers), opts.exec_naga)
+    latencies = sorted([latency for latency, code in results])
+    codes = {}
+    for latency, code in results:
+        codes[code] = codes.get(code, 0) + 1
+    print 'checks     %s in %.2fs, %.1f checks/s' % (len(results), wall,
+            len(results) / wall)
+    print 'latency    ' + ' '.join(['p%s=%.1fms' % (pct, naga.percentile(
+        latencies, pct) * 1000) for pct in (50, 90, 99, 100)])
+    print 'statuses   ' + ' '.join(['%s=%s' % (naga.NagaExit.prefix.get(code,
+        code), count) for code, count in sorted(codes.items())])
+    print 'peak rss   %skB per worker' % maxrss
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,43 @@
 from naga import naga
 from unittest import TestCase
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+class TempDirTestCase(TestCase):
+    """ Base for tests that need a temporary directory, e.g. for a fake
+    ssh binary or a state dir."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content, mode=0644):
+        """ Write content to the file name in the temporary directory,
+        return its path."""
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as out:
+            out.write(content)
+        os.chmod(path, mode)
+        return path
 
 class TestOptions(TestCase):
 
     def test_options(self):
         pass 
 
-def run_info(info, name):
+def run_info(info, name, **kwargs):
     """ Get sample output file and use it for input to naga info method"""
     with open('test/static/%s_%s.txt' % (info, name), 'rb') as outfile:
         out = outfile.read()
-        return getattr(naga, info)(out)
+        return getattr(naga, info)(out, **kwargs)
 
 class TestCpu(TestCase):
             
@@ -39,13 +66,76 @@ class TestCpu(TestCase):
         self.assertAlmostEqual(desc[6][1], 0.0)
         self.assertAlmostEqual(desc[7][1], 0.0)
 
+    def test_cores(self):
+        """Test cpu(..) with the usage of every core"""
+        level, desc, extra = run_info('cpu', 'basic', special='hottest')
+        self.assertAlmostEqual(level, 2/101.0)
+        self.assertEqual(extra, 'on hottest cpu1 (1.98%), cpu0 (0.99%), '
+                'cpu2 (0.99%), cpu3 (0.0%), mean 0.99%')
+        self.assertEqual([item[0] for item in desc], ['cpu', 'imbalance',
+            'cpu0', 'cpu1', 'cpu2', 'cpu3'])
+        level, desc, extra = run_info('cpu', 'basic', special='imbalance',
+                top_cores='1')
+        self.assertAlmostEqual(level, 1/101.0)
+        self.assertEqual(extra, 'imbalance, hottest cpu1 (1.98%), mean 0.99%')
+
+    def test_core_busy(self):
+        from test import benchnaga
+        out = benchnaga.proc_stat(64)
+        rows = [line.split() for line in out.splitlines()
+                if line[3:4].isdigit()]
+        busy = naga.core_busy(rows[:64], rows[64:])
+        self.assertEqual(len(busy), 64)
+        self.assertTrue(0 < min(busy) <= max(busy) < 1)
+        try:
+            import numpy
+        except ImportError:
+            return
+        for a, b in zip(busy, naga.core_busy_numpy(numpy, rows[:64],
+            rows[64:])):
+            self.assertAlmostEqual(a, b)
+
 class TestDisk(TestCase):
 
     def test_basic(self):
         """Test disk(..)"""
         level, desc, extra = run_info('disk', 'basic')
-        self.assertEqual(level, 10)
-        self.assertEqual(desc, 'in_persec=5MB;out_persec=5MB')
+        self.assertAlmostEqual(level, (1318+13157)/1024.0)
+        self.assertEqual(naga.build_perfdata(desc),
+                'in_persec=1.29MB out_persec=12.85MB')
+        level, desc, extra = run_info('disk', 'basic', block=4096)
+        self.assertEqual(naga.build_perfdata(desc),
+                'in_persec=5.15MB out_persec=51.39MB')
+
+    def test_diskstats(self):
+        """Test disk(..) with two reads of /proc/diskstats"""
+        level, desc, extra = run_info('disk', 'diskstats')
+        self.assertAlmostEqual(level, 20.0)
+        self.assertEqual(extra, 'on nvme0n1 (20.0MB/s), sda (1.5MB/s), '
+                'sdb (0.0MB/s), dm-0 (0.0MB/s)')
+        self.assertEqual(len(desc), 20)
+        sda = dict(desc[10:15])
+        self.assertAlmostEqual(sda['sda_read'], 0.5)
+        self.assertAlmostEqual(sda['sda_write'], 1.0)
+        self.assertAlmostEqual(sda['sda_iops'], 150)
+        self.assertAlmostEqual(sda['sda_await'], 1100/300.0)
+        self.assertAlmostEqual(sda['sda_util'], 50)
+
+    def test_targets(self):
+        """Test disk with devices given with -s"""
+        level, desc, extra = run_info('disk', 'diskstats', special='sd?')
+        self.assertAlmostEqual(level, 1.5)
+        self.assertEqual([name for name, value in desc][::5],
+                ['sda_read', 'sdb_read'])
+        level, desc, extra = run_info('disk', 'diskstats', special='sda1')
+        self.assertEqual(extra, 'on sda1')
+        self.assertRaises(naga.NagaExit, run_info, 'disk', 'diskstats',
+                special='hda')
+
+    def test_whole_disks(self):
+        self.assertEqual(naga.whole_disks(['sda', 'sda1', 'nvme0n1',
+            'nvme0n1p2', 'mmcblk0', 'mmcblk0p1', 'loop3', 'ram0', 'md127',
+            'dm-1']), ['sda', 'nvme0n1', 'mmcblk0', 'md127', 'dm-1'])
 
 class TestFilesystem(TestCase):
     """ Collection of tests for filesystem(..)"""
@@ -56,11 +146,12 @@ class TestFilesystem(TestCase):
         self.assertAlmostEqual(level, 0.208, places=3)
         self.assertEqual(len(desc), 4)
         self.assertEqual(extra, 'on /')
-        self.assertEqual(desc[0], ("'/'", '115065400;;;0;23939856'))
-        self.assertEqual(desc[1], ("'/mnt/bigdisk'", "2884152536;;;0;1472177232"))
-        self.assertEqual(desc[2], ("'/media/david/d5fd6b6e-c3fb-4399-bee7-8ae6bfe985ba'", 
-            "952912348;;;0;521857176"))
-        self.assertEqual(desc[3], ("'/mnt/backup'", "952912348;;;0;521857176"))
+        self.assertEqual(naga.build_perfdata(desc).split(), [
+            "'/'=115065400;;;0;23939856",
+            "'/mnt/bigdisk'=2884152536;;;0;1472177232",
+            "'/media/david/d5fd6b6e-c3fb-4399-bee7-8ae6bfe985ba'="
+            "952912348;;;0;521857176",
+            "'/mnt/backup'=952912348;;;0;521857176"])
 
     def test_redhat(self):
         """Test filesystem on redhat"""
@@ -68,7 +159,8 @@ class TestFilesystem(TestCase):
         self.assertAlmostEqual(level, 0.325, places=3)
         self.assertEqual(len(desc), 1)
         self.assertEqual(extra, 'on /')
-        self.assertEqual(desc[0], ("'/'", '286449848;;;0;93215152'))
+        self.assertEqual(naga.build_perfdata(desc[:1]),
+                "'/'=286449848;;;0;93215152")
 
     def test_hpux(self):
         """Test filesystem on HP-UX"""
@@ -81,6 +173,18 @@ class TestFilesystem(TestCase):
         self.assertAlmostEqual(level, 0.132, places=3)
         self.assertEqual(len(desc), 2)
 
+    def test_targets(self):
+        """Test filesystem with a list of mounts and patterns"""
+        level, desc, extra = run_info('filesystem', 'basic',
+                special='/, /mnt/*,/run/*')
+        self.assertAlmostEqual(level, 0.548, places=3)
+        self.assertEqual(extra, 'on /mnt/backup (54.76%), '
+                '/mnt/bigdisk (51.04%), / (20.81%), /run/user (0.06%), '
+                '/run/shm (0.02%), /run/lock (0.0%)')
+        self.assertEqual(len(desc), 7)
+        self.assertRaises(naga.NagaExit, run_info, 'filesystem', 'basic',
+                special='/srv*')
+
 class TestLoad(TestCase):
     """ Collection of tests for load(..)"""
 
@@ -103,13 +207,57 @@ class TestMemory(TestCase):
         level, desc, extra = run_info('memory', 'basic')
         self.assertAlmostEqual(level, 0.475, places=3)
         self.assertEqual(extra, '')
-        self.assertEqual(len(desc), 6)
+        self.assertEqual(len(desc), 8)
         self.assertEqual(desc[0], ('total', 7960))
         self.assertEqual(desc[1], ('used', 3780))
         self.assertEqual(desc[2], ('free', 4180))
         self.assertEqual(desc[3], ('shared', 0))
         self.assertEqual(desc[4], ('buff', 475))
         self.assertEqual(desc[5], ('cache', 2718))
+        self.assertEqual(desc[6:], [('swap_total', 0), ('swap_used', 0)])
+
+    def test_procps(self):
+        """Test memory(..) with free -m of newer procps"""
+        level, desc, extra = run_info('memory', 'procps')
+        self.assertAlmostEqual(level, 0.5)
+        self.assertEqual(desc[1], ('used', 8512))
+        self.assertEqual(desc[4:], [('cache', 6400), ('available', 7968),
+            ('swap_total', 4096), ('swap_used', 1024)])
+        level, desc, extra = run_info('memory', 'procps', special='used')
+        self.assertAlmostEqual(level, 8512 / 15936.0)
+        self.assertEqual(extra, 'excluding buffers/cache')
+        self.assertRaises(naga.NagaExit, run_info, 'memory', 'procps',
+                special='committed')
+
+    def test_meminfo(self):
+        """Test memory(..) with /proc/meminfo"""
+        level, desc, extra = run_info('memory', 'meminfo')
+        self.assertAlmostEqual(level, 0.5)
+        self.assertEqual(extra, '')
+        detail = dict(desc)
+        self.assertAlmostEqual(detail['total'], 15936.0, places=1)
+        self.assertAlmostEqual(detail['used'], 8512.0, places=1)
+        self.assertAlmostEqual(detail['cache'], 5888.0)
+        self.assertAlmostEqual(detail['dirty'], 20.0)
+        self.assertAlmostEqual(detail['slab_unreclaim'], 256.0)
+        self.assertAlmostEqual(detail['hugepages'], 1024.0)
+        self.assertAlmostEqual(detail['hugepages_free'], 256.0)
+        for basis, expected in (('used', 8512 / 15936.0), ('swap', 0.25),
+                ('committed', 1.2)):
+            level, desc, extra = run_info('memory', 'meminfo', special=basis)
+            self.assertAlmostEqual(level, expected, places=3)
+            self.assertEqual(extra, naga.MEMORY_BASES[basis])
+        self.assertRaises(naga.NagaExit, run_info, 'memory', 'meminfo',
+                special='bogus')
+
+    def test_meminfo_old_kernel(self):
+        """Test memory(..) with /proc/meminfo without MemAvailable"""
+        with open('test/static/memory_meminfo.txt') as meminfo:
+            out = ''.join([line for line in meminfo
+                if not line.startswith(('MemAvailable', 'Swap'))])
+        level, desc, extra = naga.memory(out)
+        self.assertAlmostEqual(level, 8512 / 15936.0, places=3)
+        self.assertEqual(naga.memory(out, special='swap')[0], 0)
 
 class TestNetwork(TestCase):
     """ Collection of tests for network(..)"""
@@ -127,6 +275,110 @@ class TestNetwork(TestCase):
         self.assertEqual(desc[4], ('rename3_rx', 0))
         self.assertEqual(desc[5], ('rename3_tx', 0))
 
+    def test_targets(self):
+        """Test network with a pattern matching several interfaces"""
+        level, desc, extra = run_info('network', 'basic', special='lo,eth*')
+        self.assertAlmostEqual(level, 0.668, places=3)
+        self.assertEqual(extra, 'on eth4 (0.67MB/s), lo (0.0MB/s)')
+        self.assertRaises(naga.NagaExit, run_info, 'network', 'basic',
+                special='wlan*')
+
+    def test_match_targets(self):
+        names = dict.fromkeys(['eth0', 'eth1', 'lo', 'veth12', 'veth3'])
+        self.assertEqual(naga.match_targets('lo', names), ['lo'])
+        self.assertEqual(naga.match_targets('veth*, lo,eth0, veth3', names),
+                ['veth12', 'veth3', 'lo', 'eth0'])
+        self.assertEqual(naga.match_targets('eth9', names), [])
+
+    def test_net_dev(self):
+        """Test network(..) with two reads of /proc/net/dev"""
+        level, desc, extra = run_info('network', 'dev')
+        self.assertAlmostEqual(level, 6.0)
+        self.assertEqual(extra, 'on eth0')
+        self.assertEqual(len(desc), 32)
+        eth0 = dict(desc[8:16])
+        self.assertAlmostEqual(eth0['eth0_rx'], 5*1024*1024)
+        self.assertAlmostEqual(eth0['eth0_tx_packets'], 1000)
+        self.assertAlmostEqual(eth0['eth0_rx_errs'], 0.4)
+        self.assertAlmostEqual(eth0['eth0_rx_drop'], 2)
+
+    def test_net_dev_patterns(self):
+        """Test network with include and exclude patterns"""
+        level, desc, extra = run_info('network', 'dev', special='!veth*,!lo')
+        self.assertEqual(extra, 'on eth0 (6.0MB/s), docker0 (1.0MB/s)')
+        self.assertEqual(len(desc), 16)
+        level, desc, extra = run_info('network', 'dev', special='*0,!eth*')
+        self.assertEqual(extra, 'on docker0')
+        self.assertRaises(naga.NagaExit, run_info, 'network', 'dev',
+                special='!*')
+        self.assertEqual(naga.split_patterns(' a*, !b,c,!d* '),
+                ('a*,c', 'b,d*'))
+
+
+class TestBuildCommand(TempDirTestCase):
+    """ Collection of tests for build_command(..)"""
+
+    def test_default(self):
+        self.assertEqual(naga.build_command('load'),
+                naga.INFO_CHOICES['load'])
+        self.assertEqual(naga.build_command('network', special=None),
+                naga.INFO_CHOICES['network'])
+        self.assertTrue("'^cpu'" in naga.build_command('cpu'))
+
+    def test_filesystem(self):
+        self.assertEqual(naga.build_command('filesystem', special='/, /var'),
+                ['/bin/df', '-P', '/', '/var', '||', 'true'])
+        self.assertEqual(naga.build_command('filesystem', special='/data*'),
+                naga.INFO_CHOICES['filesystem'])
+
+    def test_network(self):
+        cmd = naga.build_command('network', special='eth*,lo,!veth*')
+        self.assertEqual(cmd.count("'^ *(eth[^:]*|lo):'"), 2)
+        self.assertTrue('/bin/sleep' in cmd)
+        self.assertEqual(naga.network_read('!veth*'),
+                ['/bin/cat', '/proc/net/dev'])
+        steps = naga.parse_local(naga.network_read('e?h[!1].x'))
+        self.assertEqual(steps[0][1][0][2], "'^ *(e[^:]h[^1][.]x):'")
+        ret, out, err = naga.run_local(naga.parse_local(['/bin/grep', '-E',
+            "'^ *(eth[^:]*|lo):'", 'test/static/network_dev.txt']),
+            time.time(), 10)
+        self.assertEqual([line.split(':')[0].strip() for line in
+            out.splitlines()], ['lo', 'eth0', 'lo', 'eth0'])
+
+    def test_hostile_special(self):
+        """ -s can not add shell syntax to the command line."""
+        target = os.path.join(self.tmp, 'pwned')
+        for info, special in (('filesystem', '/;touch %s' % target),
+                ('filesystem', '/,$(touch %s)' % target),
+                ('filesystem', '-x'),
+                ('network', "eth0';touch %s;'" % target),
+                ('network', 'eth0,`touch %s`' % target)):
+            self.assertRaises(naga.NagaExit, naga.build_command, info,
+                    special=special)
+            code, out, err = naga.run(['-H', 'localhost', '-i', info,
+                '-s', special])
+            self.assertEqual(code, 3)
+            self.assertTrue(out.startswith('Unknown: invalid '))
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(naga.build_command('filesystem',
+            special='/, /var/lib/docker@1')[-4:-2], ['/', '/var/lib/docker@1'])
+
+    def test_missing_target(self):
+        # remote filtering leaves reporting a missing target to the parser
+        for args, out in (
+                (['-i', 'filesystem', '-s', '/nosuchmount'],
+                    'Unknown: could not find filesystem /nosuchmount'),
+                (['-i', 'network', '-s', 'wlan9', '--network-window', '0'],
+                    'Unknown: invalid interface wlan9\n')):
+            code, result, err = naga.run(['-H', 'localhost'] + args)
+            self.assertEqual(code, 3)
+            self.assertTrue(result.startswith(out))
+
+    def test_compress(self):
+        cmd = naga.ssh_command('host', 10, 'ssh', time.time(), ['/bin/true'],
+                compress=True)
+        self.assertTrue(' -C ' in cmd)
+
 
                 
 class TestFormatNum(TestCase):
@@ -139,7 +391,1103 @@ class TestFormatNum(TestCase):
         self.assertEqual(fmn(0.042642), '0.04')
         self.assertEqual(fmn(13424L), '13424')
 
+class TestTransport(TempDirTestCase):
+    """ Collection of tests for the transports."""
+
+    def test_choice(self):
+        self.assertEqual(naga.transport('localhost'), 'local')
+        self.assertEqual(naga.transport('localhost', logname='other'), 'ssh')
+        self.assertEqual(naga.transport('web1'), 'ssh')
+        self.assertEqual(naga.transport('web1', multiplex=True), 'mux')
+        self.assertEqual(naga.transport('localhost', transport='ssh'), 'ssh')
+        self.assertRaises(naga.NagaExit, naga.transport_command, 'localhost', 10,
+                'ssh', time.time(), ['/bin/echo', 'x'])
+
+    def test_parse_local(self):
+        steps = naga.parse_local(['/bin/cat', 'a', '|', 'wc', '-l', '&&',
+            '/bin/echo', "'b c'"])
+        self.assertEqual(steps, [(None, [['/bin/cat', 'a'], ['wc', '-l']]),
+            ('&&', [['/bin/echo', "'b c'"]])])
+        self.assertEqual(naga.parse_local(['/bin/cat', 'a', '2>/dev/null']),
+                None)
+        self.assertEqual(naga.parse_local(['/bin/echo', "it's"]), None)
+        self.assertEqual(naga.parse_local(['/bin/echo', '&&']), None)
+
+    def run_local(self, command):
+        return naga.run_local(naga.parse_local(command), time.time(), 10)
+
+    def test_run_local(self):
+        ret, out, err = self.run_local(naga.INFO_CHOICES['load'][:2] + ['&&',
+            '/bin/cat', 'test/static/cpu_basic.txt', '|', '/bin/grep',
+            "'^cpu[0-9]'", '|', 'wc', '-l'])
+        self.assertEqual(ret, 0)
+        self.assertEqual(out.splitlines()[-1], '8')
+        ret, out, err = self.run_local(['/bin/cat', 'missing', '&&',
+            '/bin/echo', 'no', '||', '/bin/echo', 'yes', ';', '/bin/ls',
+            'test/static/load_*'])
+        self.assertEqual((ret, out), (0, 'yes\ntest/static/load_basic.txt\n'))
+        self.assertTrue(err.startswith('cat: missing: '))
+        self.assertEqual(self.run_local(['/bin/grep', 'xyz',
+            'test/static/load_basic.txt'])[:2], (1, ''))
+        # commands without a builtin run as child processes
+        self.assertEqual(self.run_local(['/bin/echo', 'a', '|', 'tr', 'a',
+            'b', '|', 'wc', '-l', ';', 'printf', 'c']), (0, '1\nc', ''))
+        self.assertEqual(self.run_local(['exit', '255', '||', 'nosuch'])[0],
+                127)
+
+    def test_no_shell(self):
+        mark = os.path.join(self.tmp, 'mark')
+        # arguments reach the child process as they are
+        self.assertEqual(self.run_local(['printf', '%s', 'a;touch', mark]),
+                (0, 'a;touch' + mark, ''))
+        self.assertRaises(naga.NagaExit, naga.connect, 'localhost', 'load',
+                10, 'ssh', command=['/bin/echo', '$(touch', mark + ')'])
+        self.assertRaises(naga.NagaExit, naga.connect, 'localhost', 'load',
+                10, 'ssh', command=['/bin/cat', 'x', '>', mark])
+        self.assertFalse(os.path.exists(mark))
+
+    def test_connect(self):
+        out = naga.connect('localhost', 'load', 10, '/nonexistent/ssh',
+                command=['/bin/cat', 'test/static/load_basic.txt'])
+        with open('test/static/load_basic.txt') as load:
+            self.assertEqual(out, (0, load.read(), ''))
+
     
+class TestScript(TempDirTestCase):
+    """ Collection of tests for remote commands sent as a script."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # fake ssh that runs the remote command line with /bin/sh
+        self.binary = self.write('ssh', '#!/bin/sh\nfor arg; do cmd=$arg; '
+                'done\nexec /bin/sh -c "$cmd"\n', 0755)
+
+    def connect(self, command, **kwargs):
+        return naga.connect('web1', 'load', 10, self.binary, command=command,
+                transport='ssh', **kwargs)[:2]
+
+    def test_same_output(self):
+        commands = [
+            ['/bin/cat', 'test/static/load_basic.txt'],
+            ['/bin/cat', 'test/static/network_dev.txt', '|', '/bin/grep',
+                '-E', "'^ *(eth[^:]*|lo):'", '|', 'wc', '-l'],
+            ['/bin/grep', '-E', "'^ *(eth[^:]*|lo):'",
+                'test/static/network_dev.txt'],
+            ['/bin/grep', "'^cpu'", 'test/static/cpu_basic.txt', '&&',
+                '/bin/echo', 'NAGA_DIVIDE', '&&', '/bin/sleep', '0'],
+            ['/bin/cat', 'test/static/nosuch', '||', '/bin/echo', 'fallback'],
+            ['/bin/grep', "'^nosuch'", 'test/static/load_basic.txt', ';',
+                '/bin/cat', 'test/static/load_basic.txt', 'test/static/nosuch',
+                '||', '/bin/echo', 'missing'],
+            ['/bin/df', '-P', '|', '/bin/grep', "'/'", '|', 'wc', '-l'],
+            ]
+        for command in commands:
+            self.assertEqual(self.connect(command, script=True),
+                    self.connect(command))
+
+    def test_payload(self):
+        command = naga.build_command('load')
+        self.assertEqual(naga.remote_payload(command), (command, None))
+        remote, script = naga.remote_payload(command, script=True)
+        self.assertEqual(remote, naga.SCRIPT_COMMAND)
+        self.assertFalse(' | ' in script)
+        self.assertFalse('/bin/cat' in script or 'wc' in script)
+        cpu = naga.remote_script(naga.build_command('cpu'))
+        self.assertEqual(cpu.count('/bin/sleep'), 1)
+        self.assertFalse('/bin/grep' in cpu)
+        # shell syntax the script can not render is run as is
+        command = ['/bin/cat', 'test/static/nosuch', '2>/dev/null']
+        self.assertEqual(naga.remote_payload(command, script=True),
+                (command, None))
+
+    def test_case_pattern(self):
+        self.assertEqual(naga.case_pattern("'^cpu'"), ("'cpu'*", False))
+        self.assertEqual(naga.case_pattern("'model name'"),
+                ("*'model name'*", False))
+        self.assertEqual(naga.case_pattern("'^ *(e[^:]h[^1][.]x|lo):'",
+            True), ("'e'[!:]'h'[!1]'.x:'*|'lo:'*", True))
+        self.assertEqual(naga.case_pattern("'^sd.*1$'"), ("'sd'*'1'", False))
+        self.assertEqual(naga.case_pattern("'a+'"), (None, False))
+        self.assertEqual(naga.case_pattern("'(a|b)'"), ("*'(a|b)'*", False))
+
+class TestMultiplex(TestCase):
+    """ Collection of tests for the ssh control socket handling."""
+
+    def setUp(self):
+        self.control_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.control_dir)
+
+    def bind(self, name, listen=True):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(os.path.join(self.control_dir, name))
+        if listen:
+            sock.listen(1)
+        return sock
+
+    def test_control_path(self):
+        path = naga.control_path('/tmp/naga', 'bob@host1')
+        self.assertEqual(path, '/tmp/naga/bob@host1:22')
+        path = naga.control_path('/tmp/naga', 'bob@host1', '2222')
+        self.assertEqual(path, '/tmp/naga/bob@host1:2222')
+
+    def test_prune_masters(self):
+        live = self.bind('bob@live:22')
+        stale = self.bind('bob@stale:22', listen=False)
+        open(os.path.join(self.control_dir, 'bob@live:22.lock'), 'w').close()
+        try:
+            paths = naga.prune_masters(self.control_dir)
+        finally:
+            live.close()
+            stale.close()
+        self.assertEqual(paths, [os.path.join(self.control_dir, 'bob@live:22')])
+        self.assertEqual(sorted(os.listdir(self.control_dir)),
+                ['bob@live:22', 'bob@live:22.lock'])
+
+class TestBatch(TempDirTestCase):
+    """ Collection of tests for batch mode."""
+
+    def batch_output(self, *names):
+        out = ''
+        for info, name in names:
+            with open('test/static/%s_%s.txt' % (info, name), 'rb') as outfile:
+                out += '%s_%s\n%s' % (naga.BATCH_DIVIDE, info, outfile.read())
+        return out
+
+    def test_parse_batch(self):
+        checks = naga.parse_batch('load, cpu:cpu1,filesystem:/data')
+        self.assertEqual(checks, [('load', None), ('cpu', 'cpu1'),
+            ('filesystem', '/data')])
+        self.assertEqual(len(naga.parse_batch('all')), len(naga.INFO_CHOICES))
+        self.assertRaises(naga.NagaExit, naga.parse_batch, 'load,bogus')
+
+    def test_batch_command(self):
+        cmd = naga.batch_command([('memory', None), ('filesystem', None)])
+        self.assertEqual(' '.join(cmd), '/bin/echo NAGA_BATCH_memory && '
+                '/bin/cat /proc/meminfo || /usr/bin/free -m ; '
+                '/bin/echo NAGA_BATCH_filesystem && /bin/df -P')
+
+    def test_split_batch(self):
+        out = self.batch_output(('load', 'basic'), ('memory', 'basic'))
+        sections = naga.split_batch(out)
+        self.assertEqual(sorted(sections), ['load', 'memory'])
+        self.assertEqual(sections['load'], '0.19 0.22 0.30 4/554 32186\n2\n')
+        self.assertEqual(naga.memory(sections['memory'])[0],
+                run_info('memory', 'basic')[0])
+
+    def test_run_batch(self):
+        out = self.batch_output(('load', 'basic'), ('memory', 'basic'))
+        binary = self.write('ssh', '#!/bin/sh\ncat %s\n' % self.write('out',
+            out), 0755)
+        # -s only applies to single checks, batch items have their own
+        results = naga.run_batch('web1', [('load', None), ('memory', None)],
+                10, binary, time.time(), special='x')
+        self.assertEqual([result[:2] for result in results],
+                [('load', 0), ('memory', 0)])
+
+    def test_finish_batch(self):
+        results = [('load', 0, 'load ok', 'load1=0.1'),
+                ('memory', 1, 'memory high', 'used=9'),
+                ('cpu', 3, 'invalid cpu', None)]
+        try:
+            naga.finish_batch(results)
+        except naga.NagaExit as exc:
+            pass
+        self.assertEqual(exc.code, 3)
+        self.assertEqual(exc.collate_output().splitlines(), [
+            'Unknown: 3 checks, warning memory; unknown cpu | load1=0.1 used=9',
+            'OK: load ok', 'Warning: memory high', 'Unknown: invalid cpu'])
+
+    def test_worst(self):
+        self.assertEqual(naga.worst([0, 1, 3]), 3)
+        self.assertEqual(naga.worst([0, 2, 3]), 2)
+
+    def test_submit_passive(self):
+        path = tempfile.mktemp()
+        try:
+            naga.submit_passive(path, [('web1', 'load', 0, 'load ok', 'l=1'),
+                ('web1', 'cpu', 2, 'cpu busy', None)], now=1000)
+            with open(path) as cmdfile:
+                lines = cmdfile.read().splitlines()
+        finally:
+            os.unlink(path)
+        self.assertEqual(lines, [
+            '[1000] PROCESS_SERVICE_CHECK_RESULT;web1;load;0;OK: load ok | l=1',
+            '[1000] PROCESS_SERVICE_CHECK_RESULT;web1;cpu;2;Critical: cpu busy'])
+
+class TestScheduler(TempDirTestCase):
+    """ Collection of tests for the scheduler."""
+
+    def test_read_inventory(self):
+        path = self.write('inventory', '# host info\n'
+                'web1 load\n'
+                'web1 filesystem /data service=fs_data warn=0.8 interval=60\n'
+                '\n'
+                'db1 cpu cpu1 # busy core\n')
+        checks = naga.read_inventory(path, 120)
+        self.assertEqual([(c.host, c.info, c.special, c.service, c.warn,
+            c.interval) for c in checks], [
+                ('web1', 'load', None, 'load', None, 120),
+                ('web1', 'filesystem', '/data', 'fs_data', 0.8, 60.0),
+                ('db1', 'cpu', 'cpu1', 'cpu', None, 120)])
+        path = self.write('bad', 'web1 bogus\n')
+        self.assertRaises(naga.NagaExit, naga.read_inventory, path)
+
+    def test_schedule_once(self):
+        # fake ssh binary that replays a captured output
+        binary = self.write('ssh',
+                '#!/bin/sh\ncat test/static/load_basic.txt\n', 0755)
+        spool = os.path.join(self.tmp, 'spool')
+        os.mkdir(spool)
+        checks = [naga.Check('web%s' % i, 'load') for i in range(5)]
+        count = naga.schedule(checks, 10, binary, once=True,
+                max_concurrent=2, checkresults_dir=spool)
+        self.assertEqual(count, 5)
+        results = [name for name in os.listdir(spool) if name.endswith('.ok')]
+        self.assertEqual(len(results), 1)
+        with open(os.path.join(spool, results[0][:-3])) as result:
+            content = result.read()
+        self.assertEqual(content.count('return_code=0'), 5)
+        self.assertTrue('host_name=web4\nservice_description=load\n' in content)
+
+    def test_schedule_local(self):
+        # localhost runs in process, the ssh binary is never used
+        cmdfile = os.path.join(self.tmp, 'nagios.cmd')
+        start = time.time()
+        count = naga.schedule([naga.Check('localhost', 'memory')], 10,
+                '/nonexistent/ssh', once=True, command_file=cmdfile)
+        self.assertEqual(count, 1)
+        self.assertTrue(time.time() - start < 5)
+        with open(cmdfile) as cmds:
+            self.assertTrue(';localhost;memory;0;OK: memory usage' in
+                    cmds.read())
+
+    def test_schedule_per_host(self):
+        # a due check held back by max_per_host must not spin the loop
+        binary = self.write('ssh', '#!/bin/sh\nsleep 0.5\n'
+                'cat test/static/load_basic.txt\n', 0755)
+        calls = []
+        select = naga.select.select
+        def counting(*args):
+            calls.append(args)
+            return select(*args)
+        naga.select.select = counting
+        try:
+            checks = [naga.Check('web1', 'load'), naga.Check('web1', 'load')]
+            count = naga.schedule(checks, 10, binary, once=True,
+                    max_per_host=1, command_file=os.path.join(self.tmp, 'cmd'))
+        finally:
+            naga.select.select = select
+        self.assertEqual(count, 2)
+        self.assertTrue(len(calls) < 20)
+
+    def test_schedule_local_thread(self):
+        # a slow local check runs beside the ssh checks, not before them
+        binary = self.write('ssh',
+                '#!/bin/sh\ncat test/static/load_basic.txt\n', 0755)
+        cmdfile = os.path.join(self.tmp, 'nagios.cmd')
+        checks = [naga.Check('web1', 'load'), naga.Check('localhost', 'cpu'),
+                naga.Check('web2', 'load'),
+                naga.Check('web3', 'network', special='eth0;x')]
+        count = naga.schedule(checks, 0.8, binary, once=True,
+                command_file=cmdfile)
+        # a check that can not start counts as run too
+        self.assertEqual(count, 4)
+        with open(cmdfile) as cmds:
+            results = dict([(line.split(';')[1], line.split(';')[3]) for line
+                in cmds.read().splitlines()])
+        self.assertEqual((results['web1'], results['web2'], results['web3']),
+                ('0', '0', '3'))
+
+    def test_schedule_master(self):
+        # a master that takes long to start does not hold up the loop, the
+        # checks use plain ssh until it is up
+        binary = self.write('ssh', '#!/bin/sh\necho "$*" >> %s/calls\n'
+                'case "$*" in\n*" -N -f "*) sleep 2;;\n'
+                '*) cat test/static/load_basic.txt;;\nesac\n' % self.tmp, 0755)
+        cmdfile = os.path.join(self.tmp, 'nagios.cmd')
+        start = time.time()
+        try:
+            count = naga.schedule([naga.Check('web1', 'load'),
+                naga.Check('web2', 'load')], 10, binary, once=True,
+                command_file=cmdfile, multiplex=True, control_dir=self.tmp)
+            self.assertTrue(time.time() - start < 1.5)
+            self.assertEqual(len(naga.STARTING_MASTERS), 2)
+        finally:
+            for proc, lock, until in naga.STARTING_MASTERS.values():
+                naga.reap(proc)
+                lock.close()
+            naga.STARTING_MASTERS.clear()
+        self.assertEqual(count, 2)
+        with open(cmdfile) as cmds:
+            self.assertEqual(cmds.read().count(';0;OK: load usage'), 2)
+
+    def test_schedule_timeout(self):
+        binary = self.write('ssh', '#!/bin/sh\nexec sleep 5\n', 0755)
+        cmdfile = os.path.join(self.tmp, 'nagios.cmd')
+        checks = [naga.Check('web1', 'cpu')]
+        naga.schedule(checks, 0.2, binary, once=True, command_file=cmdfile)
+        with open(cmdfile) as cmds:
+            self.assertTrue(cmds.read().endswith(
+                ';web1;cpu;3;Unknown: timeout after waiting for ssh (0.2s)\n'))
+
+class TestCommunicate(TestCase):
+    """ Collection of tests for communicate(..)"""
+
+    def popen(self, script):
+        return subprocess.Popen(['/bin/sh', '-c', script],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_large_output(self):
+        """Output larger than the pipe buffers must not deadlock"""
+        proc = self.popen('head -c 300000 /dev/zero >&2; '
+                'head -c 300000 /dev/zero; echo done')
+        ret, out, err = naga.communicate(proc, time.time(), 10)
+        self.assertEqual(ret, 0)
+        self.assertEqual(len(out), 300005)
+        self.assertEqual(len(err), 300000)
+
+    def test_done(self):
+        """Stop reading once done(..) has seen the line it wants"""
+        proc = self.popen('echo a; echo b; sleep 10; echo c')
+        seen = []
+        def done(lines):
+            seen.extend(lines)
+            return 'b' in lines
+        start = time.time()
+        ret, out, err = naga.communicate(proc, start, 10, done)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual((ret, out), (0, 'a\nb\n'))
+        self.assertEqual(seen, ['a', 'b'])
+
+    def test_timeout(self):
+        proc = self.popen('sleep 10')
+        start = time.time()
+        self.assertRaises(naga.NagaExit, naga.communicate, proc, start, 0.2)
+        self.assertTrue(time.time() - start < 5)
+        # the process is reaped and its pipes closed
+        self.assertNotEqual(proc.returncode, None)
+        self.assertTrue(proc.stdout.closed and proc.stderr.closed)
+
+    def test_filesystem_stream(self):
+        self.assertEqual(naga.filesystem_stream(), None)
+        done = naga.filesystem_stream(special='/boot')
+        self.assertFalse(done(['Filesystem 1K-blocks Used Available Use% Mounted on',
+            '/dev/sda1 100 50 50 50% /']))
+        self.assertTrue(done(['/dev/sda2 100 50 50 50% /boot']))
+
+class TestCounters(TempDirTestCase):
+    """ Collection of tests for the counter store."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # fake ssh printing a sample of /proc/stat that advances 10 seconds
+        # (1000 jiffies, 10% busy) for every read in the command
+        self.binary = self.write('ssh', '''#!/bin/sh
+echo x >> %(tmp)s/calls
+n=$(cat %(tmp)s/n 2>/dev/null || echo 100)
+sample() {
+    printf 'NAGA_SAMPLE\\n%%s.00 1.00\\n' $n
+    printf 'cpu  %%s 0 0 %%s 0 0 0\\nintr 1 2 3\\n' $((n*10)) $((n*90))
+    n=$((n+10))
+}
+for arg; do cmd=$arg; done
+for read in $(echo "$cmd" | grep -o NAGA_SAMPLE); do
+    sample
+done
+echo $n > %(tmp)s/n
+''' % {'tmp': self.tmp}, 0755)
+
+    def run_counters(self):
+        return naga.counters('web1', 'cpu', 10, self.binary, time.time(),
+                state_dir=self.tmp)
+
+    def calls(self):
+        with open(os.path.join(self.tmp, 'calls')) as calls:
+            return len(calls.readlines())
+
+    def test_counters(self):
+        out, elapsed = self.run_counters()
+        # first run has no stored sample, so it reads twice in one session
+        self.assertEqual(elapsed, 10)
+        self.assertEqual(self.calls(), 1)
+        self.assertEqual(out[1], 'cpu  1000 0 0 9000 0 0 0\n'
+                'cpu  1100 0 0 9900 0 0 0\n')
+        self.assertAlmostEqual(naga.cpu(out[1])[0], 0.1)
+        out, elapsed = self.run_counters()
+        self.assertEqual(elapsed, 10)
+        self.assertEqual(out[1], 'cpu  1100 0 0 9900 0 0 0\n'
+                'cpu  1200 0 0 10800 0 0 0\n')
+        name = 'web1_cpu_' + naga.command_digest(naga.counter_command('cpu'))
+        with open(os.path.join(self.tmp, 'counters', name)) as state:
+            self.assertEqual(state.read(), 'NAGA_SAMPLE\n120.0\n'
+                    'cpu  1200 0 0 10800 0 0 0\n')
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'counters')),
+                [name])
+        self.assertEqual(self.calls(), 2)
+        # a sample older than counter_max_age is not used
+        os.utime(os.path.join(self.tmp, 'counters', name), (0, 0))
+        out, elapsed = self.run_counters()
+        self.assertEqual(out[1], 'cpu  1300 0 0 11700 0 0 0\n'
+                'cpu  1400 0 0 12600 0 0 0\n')
+        self.assertEqual(self.calls(), 3)
+
+    def test_reboot(self):
+        self.run_counters()
+        with open(os.path.join(self.tmp, 'n'), 'w') as n:
+            n.write('50')
+        out, elapsed = self.run_counters()
+        self.assertEqual(out[1], 'cpu  500 0 0 4500 0 0 0\n'
+                'cpu  600 0 0 5400 0 0 0\n')
+
+    def test_counter_delta(self):
+        self.assertEqual(naga.counter_delta(10, 15), 5)
+        self.assertEqual(naga.counter_delta(2**32-5, 5), 10)
+        self.assertEqual(naga.counter_delta(2**40, 5), 2**64-2**40+5)
+
+    def test_combine_network(self):
+        first = '  eth0: 100 1 0 0 0 0 0 0 200 2 0 0 0 0 0 0\n'
+        second = ('  eth0: 1100 11 0 0 0 0 0 0 2200 22 0 0 0 0 0 0\n'
+                '  eth1: 1 1 0 0 0 0 0 0 1 1 0 0 0 0 0 0\n')
+        out = naga.combine_counters('network', first, second)
+        level, desc, extra = naga.network(out, elapsed=2)
+        self.assertAlmostEqual(level, 3000/2/1024.0/1024)
+        self.assertEqual(desc[0], ('eth0_rx', 500))
+        self.assertEqual(extra, 'on eth0')
+
+    def test_network_interfaces(self):
+        # fake ssh reading /proc from the test directory, where eth0 and lo
+        # count 1MB and 1kB more every 10 seconds, at the start of every
+        # call and for every sleep
+        os.mkdir(os.path.join(self.tmp, 'net'))
+        self.write('tick', '''n=$(cat %(tmp)s/n 2>/dev/null || echo 100)
+echo "$n.00 1.00" > %(tmp)s/uptime
+printf '  eth0: %%s 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0\\n' $((n*104858)) \\
+    > %(tmp)s/net/dev
+printf '    lo: %%s 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0\\n' $((n*100)) \\
+    >> %(tmp)s/net/dev
+echo $((n+10)) > %(tmp)s/n
+''' % {'tmp': self.tmp})
+        self.write('ssh', '''#!/bin/sh
+sh %(tmp)s/tick
+for arg; do cmd=$arg; done
+cmd=$(echo "$cmd" | sed -e 's#/proc/#%(tmp)s/#g' \\
+    -e 's#/bin/sleep [0-9]*#sh %(tmp)s/tick#')
+exec /bin/sh -c "$cmd"
+''' % {'tmp': self.tmp}, 0755)
+        # the first check of each interface samples twice, later ones use
+        # the sample stored by the previous check of the same interface
+        for special, expected in (('eth0', 10), ('lo', 10), ('eth0', 30),
+                ('lo', 20), ('eth0', 20)):
+            out, elapsed = naga.counters('web1', 'network', 10, self.binary,
+                    time.time(), state_dir=self.tmp, special=special)
+            self.assertEqual(elapsed, expected)
+            level, desc, extra = naga.network(out[1], special=special,
+                    elapsed=elapsed)
+            self.assertEqual(extra, 'on %s' % special)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp,
+            'counters'))), 2)
+        first = '  eth0: 100 1 0 0 0 0 0 0 200 2 0 0 0 0 0 0\n'
+        self.assertRaises(ValueError, naga.combine_counters, 'network',
+                first, first, 'eth0,lo*')
+
+    def test_disk_counters(self):
+        first = ' 8 0 sda 10 0 2048 10 20 0 4096 40 0 100 50\n'
+        second = (' 8 0 sda 20 0 4096 30 40 0 8192 60 0 600 80\n'
+                ' 8 16 sdb 1 0 8 1 0 0 0 0 0 1 1\n')
+        out = naga.combine_counters('disk', first, second)
+        level, desc, extra = naga.disk(out, elapsed=2)
+        self.assertAlmostEqual(level, 1.5)
+        self.assertEqual(extra, 'on sda')
+        self.assertEqual(dict(desc)['sda_util'], 25)
+
+class TestCache(TempDirTestCase):
+    """ Collection of tests for the result cache."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # fake ssh that counts its calls and takes a while to answer
+        self.binary = self.write('ssh', '#!/bin/sh\necho x >> %s/calls\n'
+                'sleep 0.2\ncat test/static/load_basic.txt\n' % self.tmp,
+                0755)
+
+    def calls(self):
+        with open(os.path.join(self.tmp, 'calls')) as calls:
+            return len(calls.readlines())
+
+    def fetch(self, results=None, **kwargs):
+        out = naga.fetch('web1', 'load', 10, self.binary, time.time(),
+                state_dir=self.tmp, **kwargs)
+        if results is not None:
+            results.append(out)
+        return out
+
+    def test_ttl(self):
+        out = self.fetch(cache_ttl=60)
+        self.assertEqual(out[1], '0.19 0.22 0.30 4/554 32186\n2\n')
+        self.assertEqual(self.fetch(cache_ttl=60), (0, out[1], ''))
+        self.assertEqual(self.calls(), 1)
+        self.fetch(cache_ttl=60, special='other')
+        self.assertEqual(self.calls(), 2)
+        self.fetch()
+        self.assertEqual(self.calls(), 3)
+
+    def test_single_flight(self):
+        results = []
+        threads = [threading.Thread(target=self.fetch, args=(results,),
+            kwargs={'cache_ttl': 60}) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls(), 1)
+        self.assertEqual(len(set(results)), 1)
+
+    def test_evict(self):
+        cache_dir = os.path.join(self.tmp, 'cache')
+        os.mkdir(cache_dir)
+        for i in range(5):
+            path = os.path.join(cache_dir, 'entry%s' % i)
+            open(path, 'w').close()
+            open(path + '.lock', 'w').close()
+            os.utime(path, (1000 - i, 1000))
+        naga.evict(cache_dir, 3)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['entry0',
+            'entry0.lock', 'entry1', 'entry1.lock', 'entry2', 'entry2.lock'])
+
+class TestBreaker(TempDirTestCase):
+    """ Collection of tests for the circuit breaker."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.set_down(True)
+
+    def set_down(self, down):
+        """ Make the fake ssh fail to connect (down) or answer."""
+        self.binary = self.write('ssh', '#!/bin/sh\necho x >> %s/calls\n%s'
+                % (self.tmp, down and 'exit 255\n' or 'echo up\n'), 0755)
+
+    def connect(self):
+        return naga.connect('web1', 'load', 10, self.binary, time.time(),
+                state_dir=self.tmp, breaker_failures='2',
+                breaker_backoff='60')
+
+    def calls(self):
+        with open(os.path.join(self.tmp, 'calls')) as calls:
+            return len(calls.readlines())
+
+    def expire(self):
+        """ Move the next probe of web1 to now."""
+        path = os.path.join(self.tmp, 'health', 'web1')
+        failures, retry_at = naga.read_health(path)
+        naga.write_state(path, '%s %s' % (failures, time.time() - 1))
+
+    def test_breaker(self):
+        self.assertEqual(self.connect()[0], 255)
+        self.assertEqual(self.connect()[0], 255)
+        try:
+            self.connect()
+            self.fail('circuit not open')
+        except naga.NagaExit as exc:
+            self.assertEqual(exc.code, 3)
+            self.assertTrue(exc.msg.startswith('web1 is unreachable'))
+        self.assertEqual(self.calls(), 2)
+        # a failed probe doubles the wait for the next one
+        self.expire()
+        self.assertEqual(self.connect()[0], 255)
+        self.assertEqual(self.calls(), 3)
+        path = os.path.join(self.tmp, 'health', 'web1')
+        self.assertAlmostEqual(naga.read_health(path)[1] - time.time(), 120,
+                places=0)
+        self.assertRaises(naga.NagaExit, self.connect)
+        # the host answers the next probe and the circuit closes
+        self.expire()
+        self.set_down(False)
+        self.assertEqual(self.connect(), (0, 'up\n', ''))
+        self.assertEqual(self.connect(), (0, 'up\n', ''))
+        self.assertEqual(naga.read_health(path), (0, 0))
+
+    def test_disabled(self):
+        for i in range(3):
+            naga.connect('web1', 'load', 10, self.binary, time.time(),
+                    state_dir=self.tmp)
+        self.assertEqual(self.calls(), 3)
+        self.assertEqual(naga.backoff(0), naga.BREAKER_BACKOFF)
+        self.assertEqual(naga.backoff(100), naga.BREAKER_MAX_BACKOFF)
+
+class TestDeadline(TempDirTestCase):
+    """ Collection of tests for adaptive deadlines."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.path = naga.state_file(self.tmp, 'latency', 'web1')
+        self.set_delay(0)
+
+    def set_delay(self, delay):
+        """ Make the fake ssh take delay seconds to answer."""
+        self.binary = self.write('ssh', '#!/bin/sh\nsleep %s\necho up\n' %
+                delay, 0755)
+
+    def connect(self, **kwargs):
+        return naga.connect('web1', 'load', 10, self.binary, time.time(),
+                state_dir=self.tmp, deadline_factor='3',
+                deadline_floor='0.3', **kwargs)
+
+    def deadline(self, info='load'):
+        return naga.deadline('web1', naga.build_command(info), 10,
+                time.time(), state_dir=self.tmp, deadline_factor='3')
+
+    def test_cut_off(self):
+        for i in range(naga.LATENCY_MIN_SAMPLES):
+            self.assertEqual(self.connect(), (0, 'up\n', ''))
+        self.assertEqual(len(naga.read_latencies(self.path)),
+                naga.LATENCY_MIN_SAMPLES)
+        # the host hangs and is cut off long before the timeout
+        self.set_delay(5)
+        start = time.time()
+        try:
+            self.connect()
+            self.fail('not cut off')
+        except naga.NagaExit as exc:
+            self.assertTrue(exc.msg.startswith('timeout after'))
+        self.assertTrue(time.time() - start < 1)
+        self.assertAlmostEqual(naga.read_latencies(self.path)[-1], 0.3,
+                places=1)
+
+    def test_deadline(self):
+        self.assertEqual(self.deadline(), 10)
+        naga.write_state(self.path, ' '.join(['0.5'] * 4 + ['1']))
+        self.assertAlmostEqual(self.deadline(), 3, places=1)
+        # sampling sleeps are added to the deadline
+        self.assertAlmostEqual(self.deadline('cpu'), 4, places=1)
+        self.assertAlmostEqual(naga.deadline('web1', ['/bin/true'], 10,
+            time.time() - 2, state_dir=self.tmp, deadline_factor='1'),
+            2 + naga.DEADLINE_FLOOR, places=1)
+        # a host cut off keeps growing its deadline up to the timeout
+        naga.write_state(self.path, ' '.join(['3'] * 10))
+        self.assertAlmostEqual(self.deadline(), 9, places=1)
+        naga.write_state(self.path, ' '.join(['4'] * 10))
+        self.assertEqual(self.deadline(), 10)
+        naga.record_latency('web1', ['/bin/sleep', '1'], time.time() - 1.5,
+                state_dir=self.tmp, deadline_factor='3')
+        self.assertAlmostEqual(naga.read_latencies(self.path)[-1], 0.5,
+                places=1)
+
+    def test_history(self):
+        for i in range(naga.LATENCY_SAMPLES + 10):
+            naga.record_latency('web1', [], time.time() - i,
+                    state_dir=self.tmp, deadline_factor='3')
+        history = naga.read_latencies(self.path)
+        self.assertEqual(len(history), naga.LATENCY_SAMPLES)
+        self.assertAlmostEqual(history[-1], naga.LATENCY_SAMPLES + 9,
+                places=1)
+        # nothing is recorded without a factor
+        naga.connect('web2', 'load', 10, self.binary, state_dir=self.tmp)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'latency',
+            'web2')))
+
+    def test_scheduler(self):
+        naga.write_state(self.path, ' '.join(['0.1'] * 10))
+        self.set_delay(5)
+        cmdfile = os.path.join(self.tmp, 'nagios.cmd')
+        start = time.time()
+        naga.schedule([naga.Check('web1', 'load')], 10, self.binary,
+                once=True, command_file=cmdfile, state_dir=self.tmp,
+                deadline_factor='2', deadline_floor='0.2')
+        self.assertTrue(time.time() - start < 1)
+        with open(cmdfile) as cmds:
+            self.assertTrue(';web1;load;3;Unknown: timeout after waiting for '
+                    'ssh (0.2' in cmds.read())
+
+class TestProbe(TempDirTestCase):
+    """ Collection of tests for probing hosts."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # fake ssh for an HP-UX host, logging every command it runs
+        self.binary = self.write('ssh', '#!/bin/sh\necho "$*" >> %s/calls\n'
+                'case "$*" in\n'
+                '*uname*) printf "HP-UX\\n/bin/df\\n/usr/bin/vmstat\\n";;\n'
+                '*vmstat*) cat test/static/disk_basic.txt;;\n'
+                '*) exit 1;;\nesac\n' % self.tmp, 0755)
+
+    def measure(self, info):
+        return naga.measure('web1', info, 10, self.binary, time.time(),
+                state_dir=self.tmp, probe_ttl='60')
+
+    def calls(self):
+        with open(os.path.join(self.tmp, 'calls')) as calls:
+            return calls.read().splitlines()
+
+    def test_probe(self):
+        level, desc, extra = self.measure('disk')
+        self.assertEqual(naga.build_perfdata(desc),
+                'in_persec=1.29MB out_persec=12.85MB')
+        try:
+            self.measure('cpu')
+            self.fail('cpu checked on HP-UX')
+        except naga.NagaExit as exc:
+            self.assertEqual(exc.msg, 'cpu is not available on web1 (HP-UX)')
+        calls = self.calls()
+        self.assertEqual(len(calls), 2)
+        self.assertTrue('uname -s' in calls[0])
+        self.assertTrue('/usr/bin/vmstat 1 2' in calls[1])
+        self.assertFalse('diskstats' in calls[1])
+
+    def test_variant(self):
+        found = set(['/proc/diskstats', '/usr/bin/vmstat'])
+        self.assertEqual(naga.variant('web1', 'disk', 'Linux', found), None)
+        self.assertEqual(naga.variant('web1', 'filesystem', 'HP-UX',
+            set(['/usr/bin/bdf'])), ['/usr/bin/bdf'])
+        self.assertEqual(naga.variant('web1', 'memory', 'HP-UX',
+            set(['/usr/bin/free'])), ['/usr/bin/free', '-m'])
+        self.assertRaises(naga.NagaExit, naga.variant, 'web1', 'network',
+                'Darwin', found)
+
+class TestCluster(TempDirTestCase):
+    """ Collection of tests for cluster checks."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # fake ssh answering the load of web<n> as n/10 of 2 cores
+        self.binary = self.write('ssh', '#!/bin/sh\ncase "$*" in\n'
+                '*@web9*) exit 255;;\n'
+                '*@web*) n=${*##*@web}; n=${n%% *}\n'
+                '    echo "0.$n 0.1 0.1 1/100 123"; echo 2;;\n'
+                'esac\n', 0755)
+
+    def check(self, hosts, **kwargs):
+        try:
+            naga.check_cluster(hosts, 'load', 10, self.binary, time.time(),
+                    **kwargs)
+        except naga.NagaExit as exc:
+            return exc.code, exc.msg, exc.desc
+
+    def test_hosts(self):
+        self.assertEqual(naga.cluster_hosts('web1'), None)
+        self.assertEqual(naga.cluster_hosts('web1, web2'), ['web1', 'web2'])
+        path = os.path.join(self.tmp, 'hosts')
+        with open(path, 'w') as hostfile:
+            hostfile.write('web1\n# spare\n\nweb2 # db\n')
+        self.assertEqual(naga.cluster_hosts('@' + path), ['web1', 'web2'])
+        try:
+            naga.cluster_hosts('@' + path + '.missing')
+        except naga.NagaExit as exc:
+            pass
+        self.assertEqual(exc.code, 3)
+        self.assertTrue(exc.msg.startswith('could not read host list '))
+
+    def test_host_perfdata(self):
+        self.assertEqual(naga.host_perfdata('web1', [("'/my data'",
+            '10;;;0;20'), ('cpu', 50, '%')]),
+            "'web1_/my data'=10;;;0;20 web1_cpu=50%")
+
+    def test_aggregate(self):
+        levels = [(0.5, 'b'), (0.1, 'a'), (0.9, 'c'), (0.3, 'd')]
+        self.assertEqual(naga.aggregate('load', levels, 'max')[:2],
+                (0.9, 'on c of 4 hosts'))
+        self.assertEqual(naga.aggregate('load', levels, 'min')[0], 0.1)
+        self.assertAlmostEqual(naga.aggregate('load', levels, 'mean')[0],
+                0.45)
+        self.assertEqual(naga.aggregate('load', levels, 'p50')[0], 0.3)
+        self.assertEqual(naga.aggregate('load', levels, 'p100')[0], 0.9)
+        level, extra, opts = naga.aggregate('memory', levels, 'count:0.4')
+        self.assertEqual((level, extra), (2, 'of 4 hosts at or over 40.0% '
+            '(b, c)'))
+        self.assertEqual(opts['levels'], [1, 2])
+        self.assertRaises(ValueError, naga.aggregate, 'load', levels, 'sum')
+
+    def test_cluster(self):
+        status, msg, perfdata = self.check(['web1', 'web4', 'web8'])
+        self.assertEqual(status, 0)
+        self.assertEqual(msg, 'load usage is 0.4 on web8 of 3 hosts')
+        self.assertTrue(perfdata.startswith('max=0.4 web1_load1=0.1;0;2 '))
+        self.assertTrue('web8_running=1' in perfdata)
+        status, msg, perfdata = self.check(['web1', 'web4', 'web8', 'web9'],
+                aggregate='mean', warn=0.2, crit=0.5, max_concurrent='2')
+        self.assertEqual(status, 1)
+        self.assertEqual(msg, 'load usage is high 0.22 mean of 3 hosts, '
+                'unknown: web9')
+        status, msg, perfdata = self.check(['web9'])
+        self.assertEqual(status, 3)
+        status, msg, perfdata = self.check(['web1', 'web4', 'web8'],
+                aggregate='count:0.2')
+        self.assertEqual(status, 2)
+        self.assertEqual(msg, 'load usage is critical 2 of 3 hosts at or '
+                'over 0.2 (web4, web8)')
+
+class TestBenchFixtures(TestCase):
+    """ The synthetic benchmark outputs must be understood by the parsers."""
+
+    def test_fixtures(self):
+        from test import benchnaga
+        self.assertEqual(len(naga.cpu(benchnaga.proc_stat(8),
+            special='cpu7')[1]), 8)
+        self.assertEqual(naga.filesystem(benchnaga.df_p(20),
+            special='/data/*')[2].count('/data/'), 19)
+        self.assertEqual(len(naga.network(benchnaga.proc_net_dev(20))[1]), 160)
+        self.assertAlmostEqual(naga.memory(benchnaga.free_m())[0], 0.5, 2)
+        self.assertAlmostEqual(naga.memory(benchnaga.proc_meminfo())[0], 0.5,
+                2)
+        naga.disk(benchnaga.vmstat())
+        self.assertEqual(naga.disk(benchnaga.diskstats(30))[2].count('('),
+                30)
+
+class TestExport(TempDirTestCase):
+    """ Collection of tests for --export."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.path = os.path.join(self.tmp, 'metrics')
+
+    def test_main(self):
+        code, out, err = naga.run(['-H', 'dev', '-i', 'network',
+            '--transport', 'replay', '--export', self.path, '-s', 'eth0'])
+        self.assertTrue(out.startswith('Warning: network usage is high'))
+        with open(self.path) as metrics:
+            lines = metrics.read().splitlines()
+        detail = naga.network(open('test/static/network_dev.txt').read(),
+                special='eth0')[1]
+        self.assertEqual(len(lines), len(detail))
+        tags, value, stamp = lines[0].split(' ')
+        self.assertEqual(tags, 'naga,host=dev,info=network,target=eth0_rx')
+        self.assertEqual(float(value[6:]), detail[0][1])
+        self.assertAlmostEqual(int(stamp) / 10.0**9, time.time(), places=-1)
+
+    def test_disk_filesystem(self):
+        # vmstat and df detail is exported like that of the other parsers
+        for info, first in (('disk', 'target=in_persec value=1.2'),
+                ('filesystem', 'target=/ value=')):
+            with open('test/static/%s_basic.txt' % info) as capture:
+                self.write('%s_dev.txt' % info, capture.read())
+            path = '%s.%s' % (self.path, info)
+            code, out, err = naga.run(['-H', 'dev', '-i', info, '--transport',
+                'replay', '--replay-dir', self.tmp, '--export', path])
+            self.assertTrue(out.startswith(('OK:', 'Warning:')))
+            with open(path) as metrics:
+                lines = metrics.read().splitlines()
+            self.assertTrue(first in lines[0])
+        exporter = naga.Exporter(self.path)
+        exporter.add('web1', 'disk', 'in_persec=1MB;out_persec=2MB')
+        exporter.add('web1', 'disk', ['x', ('a',), ('b', 1)])
+        self.assertEqual(len(exporter.lines), 1)
+
+    def test_process(self):
+        exporter = naga.Exporter(self.path)
+        with open('test/static/load_basic.txt') as out:
+            naga.process('load', out.read(), host='web 1,a', exporter=exporter)
+        self.assertTrue(exporter.lines[0].startswith('naga,host=web\\ 1\\,a,'
+            'info=load,target=load1 value=0.19 '))
+
+    def test_fifo(self):
+        os.mkfifo(self.path)
+        exporter = naga.Exporter(self.path)
+        exporter.add('web1', 'load', [('load1', 0.1234567891234, 1, 2),
+            ('cpus', 2), ('text', 'x')], now=1)
+        # nobody reads the pipe, the lines are kept without blocking
+        exporter.flush()
+        self.assertEqual(len(exporter.lines), 2)
+        reader = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            exporter.flush()
+            self.assertEqual(os.read(reader, 4096),
+                'naga,host=web1,info=load,target=load1 value=0.1234567891234 '
+                '1000000000\nnaga,host=web1,info=load,target=cpus value=2.0 '
+                '1000000000\n')
+            # a full pipe keeps the rest for later, in whole lines
+            exporter.add('web1', 'cpu', [('cpu%s' % i, i) for i in
+                range(5000)])
+            exporter.flush()
+            self.assertTrue(0 < len(exporter.lines) < 5000)
+            data = ''
+            while exporter.lines:
+                try:
+                    data += os.read(reader, 65536)
+                except OSError:
+                    pass
+                exporter.flush()
+            data += os.read(reader, 65536)
+            self.assertEqual(len(data.splitlines()), 5000)
+            self.assertTrue(data.endswith('value=4999.0 %s\n' %
+                data.split()[-1]))
+        finally:
+            os.close(reader)
+            exporter.close()
+
+    def test_sockets(self):
+        for kind in (socket.SOCK_DGRAM, socket.SOCK_STREAM):
+            server = socket.socket(socket.AF_UNIX, kind)
+            server.bind(self.path)
+            if kind == socket.SOCK_STREAM:
+                server.listen(1)
+            exporter = naga.Exporter(self.path)
+            exporter.add('web1', 'load', [('load1', 0.5)], now=2)
+            exporter.flush()
+            conn = server
+            if kind == socket.SOCK_STREAM:
+                conn = server.accept()[0]
+            self.assertEqual(conn.recv(4096), 'naga,host=web1,info=load,'
+                    'target=load1 value=0.5 2000000000\n')
+            exporter.close()
+            conn.close()
+            server.close()
+            os.unlink(self.path)
+        # nobody listening on the socket any more
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind(self.path)
+        server.close()
+        exporter.add('web1', 'load', [('load1', 0.5)])
+        exporter.flush()
+        self.assertEqual(len(exporter.lines), 1)
+
+    def test_overflow(self):
+        exporter = naga.Exporter(self.path, max_lines=3)
+        exporter.add('web1', 'cpu', [('cpu%s' % i, i) for i in range(5)])
+        self.assertEqual([line.split()[0][-4:] for line in exporter.lines],
+                ['cpu2', 'cpu3', 'cpu4'])
+        exporter.flush()
+        self.assertEqual(len(open(self.path).readlines()), 3)
+
+class TestProfile(TempDirTestCase):
+    """ Collection of tests for --profile."""
+
+    def test_phases(self):
+        profile = naga.Profile(time.time())
+        profile.mark('ssh')
+        profile.add('parse', 0.0125)
+        profile.add('parse', 0.0125)
+        names = [item.split('=')[0] for item in profile.perfdata().split()]
+        self.assertEqual(names[-4:], ['naga_options_ms', 'naga_ssh_ms',
+            'naga_parse_ms', 'naga_total_ms'])
+        self.assertTrue('naga_parse_ms=25.0' in profile.perfdata())
+
+    def test_report(self):
+        profile = naga.Profile(time.time())
+        exc = naga.NagaExit(3, 'timeout after waiting for Popen (1.0s)')
+        profile.report(exc, 'web1', 'load')
+        self.assertTrue(exc.desc.startswith('naga_'))
+        exc = naga.NagaExit(0, 'load ok', 'load1=0.1')
+        profile.report(exc, 'web1', 'load')
+        self.assertTrue(exc.desc.startswith('load1=0.1 naga_'))
+
+    def test_check(self):
+        binary = self.write('ssh',
+                '#!/bin/sh\ncat test/static/load_basic.txt\n', 0755)
+        profile = naga.Profile(time.time())
+        try:
+            naga.check('web1', 'load', 10, binary, time.time(),
+                    profile=profile)
+        except naga.NagaExit as exc:
+            pass
+        self.assertEqual(exc.code, 0)
+        for phase in ('ssh', 'remote', 'transfer', 'parse', 'evaluate'):
+            self.assertTrue(phase in profile.phases)
+
+class TestServer(TempDirTestCase):
+    """ Collection of tests for the resident server and its client."""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.binary = self.write('ssh',
+                '#!/bin/sh\ncat test/static/load_basic.txt\n', 0755)
+
+    def test_run(self):
+        code, out, err = naga.run(['-H', 'web1', '-b', self.binary, '-w',
+            '0.05', '-c', '0.5'])
+        self.assertEqual((code, err), (1, ''))
+        self.assertTrue(out.startswith('Warning: load usage is high 0.1 '))
+        code, out, err = naga.run(['--bogus'])
+        self.assertEqual((code, out), (2, ''))
+        self.assertTrue('no such option: --bogus' in err)
+
+    def test_empty_request(self):
+        # connecting without sending a command line runs no check
+        calls = []
+        run = naga.run
+        naga.run = lambda args: calls.append(args) or (0, '', '')
+        server, client = socket.socketpair()
+        try:
+            client.shutdown(socket.SHUT_WR)
+            naga.handle_request(server)
+            self.assertEqual(client.recv(100), '')
+        finally:
+            naga.run = run
+            client.close()
+        self.assertEqual(calls, [])
+
+    def test_client(self):
+        path = os.path.join(self.tmp, 'naga.sock')
+        env = dict(os.environ, NAGA_SOCKET=path)
+        args = [sys.executable, 'naga/client.py', '-H', 'web1', '-b',
+                self.binary, '-i', 'cpu', '-s', 'cpu9']
+        # without a server the client runs naga itself
+        direct = subprocess.Popen(args, env=env, stdout=subprocess.PIPE)
+        direct_out = direct.communicate()[0]
+        server = subprocess.Popen([sys.executable, 'naga/naga.py', '--server',
+            path], stdout=subprocess.PIPE)
+        try:
+            for i in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            client = subprocess.Popen(args, env=env, stdout=subprocess.PIPE)
+            client_out = client.communicate()[0]
+        finally:
+            server.terminate()
+            server.wait()
+        self.assertEqual(client.returncode, direct.returncode)
+        self.assertEqual(client.returncode, 3)
+        self.assertEqual(client_out, 'Unknown: invalid cpu: cpu9\n')
+        self.assertEqual(client_out, direct_out)
+        self.assertFalse(os.path.exists(path))
+
+class TestReplay(TestCase):
+    """ Collection of tests for the replay transport and load harness."""
+
+    def test_unsupported(self):
+        for args in (['--counters', '-i', 'cpu'], ['--batch', 'load,cpu']):
+            code, out, err = naga.run(['-H', 'web1', '--transport', 'replay']
+                    + args)
+            self.assertEqual(code, 3)
+            self.assertTrue(out.startswith('Unknown: the replay transport '
+                'does not support '))
+
+    def test_replay_command(self):
+        self.assertEqual(naga.replay_command('basic', 'load'),
+                ['/bin/cat', 'test/static/load_basic.txt'])
+        cmd = naga.replay_command('web1', 'filesystem', replay_dir='test/static',
+                replay_latency='0.5', replay_jitter='0.1')
+        self.assertEqual(cmd[:1] + cmd[2:4], ['/bin/sleep', '&&', '/bin/cat'])
+        self.assertTrue(0.4 <= float(cmd[1]) <= 0.6)
+        # the same capture is replayed for a host every time
+        self.assertEqual(cmd[-1], naga.replay_command('web1', 'filesystem',
+            replay_dir='test/static')[-1])
+        self.assertEqual(naga.replay_command('web1', 'load',
+            replay_dir='test/static', replay_failures='1'), ['exit', '255'])
+        self.assertRaises(naga.NagaExit, naga.replay_command, 'web1', 'load',
+                replay_dir='/nonexistent')
+
+    def test_main(self):
+        code, out, err = naga.run(['-H', 'basic', '-i', 'memory',
+            '--transport', 'replay'])
+        self.assertEqual(code, 0)
+        self.assertTrue(out.startswith('OK: memory usage is'))
+        code, out, err = naga.run(['-H', 'basic', '-i', 'memory',
+            '--transport', 'replay', '--replay-failures', '1'])
+        self.assertEqual((code, out), (3, 'Unknown: ssh command returncode '
+            '255 | out=;err= \n'))
+
+    def test_load(self):
+        from test import loadnaga
+        self.assertEqual(naga.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(naga.percentile([1, 2, 3, 4], 99), 4)
+        checks = [['-H', 'host%s' % i, '-i', 'load', '--transport', 'replay']
+                for i in range(10)]
+        results, wall, maxrss = loadnaga.load(checks, 2, False)
+        self.assertEqual([code for latency, code in results], [0] * 10)
+        self.assertTrue(maxrss > 0)
+
 class TestTimecheck(TestCase):
     def test_timecheck(self):
         pass